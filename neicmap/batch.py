@@ -0,0 +1,106 @@
+#!/usr/bin/python
+import os
+import tempfile
+import multiprocessing
+from neicmap.city import PagerCity,PagerCityError
+from neicmap.citystore import CityStore
+
+#PagerCity used by the current worker process (see _initWorker())
+_workercity = None
+
+class EventGrid(object):
+    """
+    Minimal stand-in for a ShakeGrid, holding only what city exposure needs (geodict and griddata).
+
+    Events are sent to worker processes as EventGrids, so only the grid arrays are pickled.
+    """
+    def __init__(self,geodict,griddata):
+        self.geodict = geodict
+        self.griddata = griddata
+
+def processEvent(pagercity,event,method='nearest'):
+    """
+    Find the cities affected by a single event.
+    @param pagercity: PagerCity object.
+    @param event: Dictionary with keys:
+                  - lat     Latitude of epicenter.
+                  - lon     Longitude of epicenter.
+                  - radius  Radius (in km) within which cities should be found.
+                  - shakegrid  (Optional) ShakeGrid object with the event's MMI grid.
+    @keyword method: Grid sampling method, 'nearest' or 'linear' (see neicmap.exposure.GridSampler).
+    @return: Dictionary with keys:
+             - cities     List of city dictionaries inside the search radius (see PagerCity.findCitiesByRadius()).
+             - exposure   List of exposed city dictionaries, with MMI (see PagerCity.getCityExposure()),
+                          or None if the event has no shakegrid.
+             - citytable  PAGER table of exposed cities (see PagerCity.getCityTable()), or None.
+    """
+    result = {'exposure':None,'citytable':None}
+    result['cities'] = pagercity.findCitiesByRadius(event['lat'],event['lon'],event['radius'])
+    shakegrid = event.get('shakegrid')
+    if shakegrid is not None:
+        result['exposure'] = pagercity.getCityExposure(shakegrid,method=method)
+        result['citytable'] = pagercity.getCityTable(result['exposure'])
+    return result
+
+def _initWorker(cachefile):
+    global _workercity
+    _workercity = PagerCity()
+    _workercity.loadCityCache(cachefile,columnar=True)
+
+def _processWorkerEvent(args):
+    event,method = args
+    return processEvent(_workercity,event,method=method)
+
+def _getWorkerEvents(events,method):
+    for event in events:
+        event = event.copy()
+        shakegrid = event.get('shakegrid')
+        if shakegrid is not None:
+            event['shakegrid'] = EventGrid(shakegrid.geodict,shakegrid.griddata)
+        yield (event,method)
+
+def processEvents(pagercity,events,nprocs=None,method='nearest',chunksize=1):
+    """
+    Find the cities affected by each of a sequence of events, using a pool of worker processes.
+
+    Workers do not receive copies of the cities.  Each one memory-maps the binary city cache
+    written by PagerCity.loadCities() (see neicmap.citystore.CityStore.load()), so all of them
+    share a single copy of the city arrays.  If the cities were not loaded from a cache, they are
+    written to a temporary cache file, which is removed when all results have been returned.
+    @param pagercity: PagerCity object.
+    @param events: Sequence (or iterator) of event dictionaries (see processEvent()).
+    @keyword nprocs: Number of worker processes (defaults to the number of CPUs).  If 1, events
+                     are processed in this process.
+    @keyword method: Grid sampling method, 'nearest' or 'linear' (see neicmap.exposure.GridSampler).
+    @keyword chunksize: Number of events sent to a worker at a time.
+    @return: Generator of result dictionaries (see processEvent()), in the same order as events;
+             each result is yielded as soon as it and all earlier results are ready.
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    if nprocs == 1:
+        for event in events:
+            yield processEvent(pagercity,event,method=method)
+        return
+    cachefile = pagercity.cachefile
+    tmpfile = None
+    if cachefile is None:
+        store = pagercity.store
+        if store is None:
+            if not len(pagercity.cities):
+                raise PagerCityError, 'processEvents requires loaded cities.'
+            store = CityStore.fromCityList(pagercity.cities)
+        handle,tmpfile = tempfile.mkstemp(suffix='.cache',prefix='neicmap')
+        os.close(handle)
+        store.save(tmpfile)
+        cachefile = tmpfile
+    pool = multiprocessing.Pool(nprocs,initializer=_initWorker,initargs=(cachefile,))
+    try:
+        for result in pool.imap(_processWorkerEvent,_getWorkerEvents(events,method),chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if tmpfile is not None and os.path.isfile(tmpfile):
+            os.remove(tmpfile)
@@ -1,67 +1,217 @@
 #!/usr/bin/python
 from xml.dom.minidom import parse
-import re
 import os.path
 import struct
 from numpy import *
-from neicmap.distance import sdist
-from neicio.grid import GridError
+from neicmap.distance import sdist,getAzimuth,getCompassDirFromAzimuth
+from neicmap.citystore import CityStore,CityStoreError,readCityFile,getSourceKey
+from neicmap.exposure import GridSampler,ExposureSession,getExposureMatrix
+from neicmap.lru import LRUCache
+from neicmap.nameindex import CityNameIndex
+from neicmap.cityquery import CityQuery
 from neicutil.text import decToRoman,commify
-from sets import Set
 
 class PagerCityError(Exception):
     """Used to handle errors for PagerCity"""
     def __str__(self):
         return repr(self.args[0])
 
-class PagerCity:
+class PagerCity(object):
     """
     Handles loading and searching for cities.
+
+    Cities loaded from a file are held in a columnar CityStore (see neicmap.citystore), which
+    the findCitiesBy* methods search with vectorized masks when no citylist is provided.
     """
-    cities = []
-    def __init__(self,cityfile=None):
+    def __init__(self,cityfile=None,columnar=False):
         """
         Instantiate PagerCity object.
         @keyword cityfile: cities1000.txt file from the GeoNames website. If no cities file is provided, 
                            each call to instance methods MUST provide a separate city list.
+        @keyword columnar: If True, keep loaded cities only in the columnar city store, and build
+                           city dictionaries only for query results.  If False, the cities attribute
+                           also holds a list of city dictionaries for every loaded city.
         """
+        self._cities = []
+        self.store = None
+        self.cachefile = None
+        self._nameindex = None
+        self.sessions = LRUCache(maxsize=64)
         if cityfile is not None:
-            self.loadCities(cityfile)
+            self.loadCities(cityfile,columnar=columnar)
+
+    def _getCityList(self):
+        if self._cities is None:
+            return self.store.getCities()
+        return self._cities
+
+    def _setCityList(self,citylist):
+        self._cities = citylist
+        self.store = None
+        self.cachefile = None
+        self._nameindex = None
+        self.sessions.clear()
+
+    cities = property(_getCityList,_setCityList,doc="""
+    List of city dictionaries.  In columnar mode this list is built from the city store on each
+    access, so changes made to it are not kept.  Assigning a new list discards the city store.
+    """)
+
+    def _getCities(self,idx):
+        """
+        Return the city dictionaries for a sequence of indices into the city store.
+        @param idx: Sequence of city indices.
+        @return: List of city dictionaries.
+        """
+        if self._cities is None:
+            return self.store.getCities(idx)
+        return [self._cities[i] for i in idx]
+
+    def query(self,citylist=None):
+        """
+        Start a lazy city search (see neicmap.cityquery.CityQuery), i.e.:
+          cities = pagercity.query().withinRadius(lat,lon,100).population(1e5,None).getCities()
+        @keyword citylist: List of city dictionaries to search from (see findCitiesByRadius()).  If
+                           None, the loaded cities are searched.
+        @return: CityQuery object matching every city, to be narrowed by its filter methods.
+        """
+        if citylist == None and self.store is not None:
+            return CityQuery(self.store,self._cities)
+        if citylist == None:
+            citylist = self.cities
+        return CityQuery(CityStore.fromCityList(citylist),citylist)
 
     def findCitiesByName(self,cityname):
-        for city in self.cities:
-            m1 = re.search(cityname,city['name'])
-            m2 = re.search(city['name'],cityname)
-            if m1 is not None or m2 is not None:
-                return city.copy()
-        return None
+        """
+        Find the city whose name best matches a string.
+
+        Names are compared case-insensitively and ignoring punctuation, and a city whose name
+        equals the string, or appears in it as whole words, is preferred to larger cities that
+        only match part of a word (see getCityNameMatches()).
+        @param cityname: String containing (part of) a city name, i.e., 'Padang, Indonesia'.
+        @return: Copy of the matching city dictionary, or None if no city matches.
+        """
+        idx = self._getNameIndex().getMatches(cityname)
+        if not len(idx):
+            return None
+        return self._getCities(idx[0:1])[0].copy()
+
+    def getCityNameMatches(self,cityname,maxcities=None):
+        """
+        Find all cities whose name contains, or is contained in, a string.
+
+        Matches are looked up in a name index (see neicmap.nameindex.CityNameIndex) built from
+        the loaded cities on first use; recent queries are cached.
+        @param cityname: String containing (part of) a city name.
+        @keyword maxcities: Maximum number of cities to return (all if None).
+        @return: List of city dictionaries, best match first (exact names, then whole words,
+                 then partial words, with ties going to the most populous city).
+        """
+        idx = self._getNameIndex().getMatches(cityname)
+        if maxcities is not None:
+            idx = idx[0:maxcities]
+        return self._getCities(idx)
+
+    def _getNameIndex(self):
+        """
+        Return the name index over the loaded cities, building it on first use.
+        @return: CityNameIndex object.
+        """
+        if self.store is not None:
+            return self.store.getNameIndex()
+        if self._nameindex is None:
+            self._nameindex = CityNameIndex([city['name'] for city in self._cities],
+                                            [city['pop'] for city in self._cities])
+        return self._nameindex
             
     def filterCitiesByGrid(self,xmin,xmax,ymin,ymax,xdim,ydim,ncities,citylist=None):
-        if citylist == None:
-            citylist = self.cities
+        """
+        Select the top cities (by capital status, then population) in each cell of a grid.
+
+        Every city is binned to the grid cells that contain it in one pass, rather than searching
+        the city list once per cell.  Cells include their edges, so a city lying exactly on the
+        edge between two cells is counted in both.  The last row and column of cells extend to
+        ymax and xmax.
+        @param xmin: Western edge of grid.
+        @param xmax: Eastern edge of grid.
+        @param ymin: Southern edge of grid.
+        @param ymax: Northern edge of grid.
+        @param xdim: Width of grid cells.
+        @param ydim: Height of grid cells.
+        @param ncities: Maximum number of cities to select from each cell.
+        @keyword citylist: List of city dictionaries to search from:
+                           - name   City name
+                           - ccode  Two-letter country code.
+                           - lat    Latitude of city center.
+                           - lon    Longitude of city center.
+                           - iscap  Boolean indicating if city is a capital of a region or country.
+                           - pop    Population of city.
+        @return: List of city dictionaries (same fields as input citylist), ordered by grid row
+                 (south to north), then column (west to east), then capital status and population.
+        """
         ncols = int((xmax - xmin)/xdim)
         nrows = int((ymax - ymin)/ydim)
-        subcities = []
-        for i in range(0,nrows):
-            bymin = ymin + i*ydim
-            bymax = bymin + ydim
-            if i == nrows-1:
-                bymax = max(bymax,ymax)
-            for j in range(0,ncols):
-                bxmin = xmin + j*xdim
-                bxmax = bxmin + xdim
-                if j == ncols-1:
-                    bxmax = max(bxmax,xmax)
-                tcities = self.findCitiesByRectangle([bxmin,bxmax,bymin,bymax],citylist)
-                
-                if len(tcities):
-                    tcities = self.sortCities(tcities,method='capital')
-                    n = min(len(tcities),ncities)
-                    for k in range(0,n):
-                        subcities.append(tcities[k])
+        if citylist == None and self.store is not None:
+            lat = self.store.lat
+            lon = self.store.lon
+        else:
+            if citylist == None:
+                citylist = self.cities
+            lat = array([city['lat'] for city in citylist],dtype=float64)
+            lon = array([city['lon'] for city in citylist],dtype=float64)
+        if nrows <= 0 or ncols <= 0 or len(lat) == 0:
+            return []
+        rows = self._getGridCells(lat,ymin,ymax,ydim,nrows)
+        cols = self._getGridCells(lon,xmin,xmax,xdim,ncols)
+        #pair every row a city falls in with every column it falls in (usually just one of each)
+        cityidx = []
+        cellidx = []
+        for rowcities,row in rows:
+            for colcities,col in cols:
+                inside = in1d(rowcities,colcities,assume_unique=True)
+                colpos = searchsorted(colcities,rowcities[inside])
+                cityidx.append(rowcities[inside])
+                cellidx.append(row[inside]*ncols + col[colpos])
+        cityidx = concatenate(cityidx)
+        cellidx = concatenate(cellidx)
+        keys = self._getSortKeys(citylist,'capital')
+        order = lexsort([key[cityidx] for key in keys] + [cellidx])
+        cityidx = cityidx[order]
+        cellidx = cellidx[order]
+        #rank of each city within its cell
+        starts = flatnonzero(concatenate(([True],cellidx[1:] != cellidx[0:-1])))
+        counts = diff(concatenate((starts,[len(cellidx)])))
+        rank = arange(0,len(cellidx)) - repeat(starts,counts)
+        cityidx = cityidx[rank < ncities]
+        if citylist == None:
+            return self._getCities(cityidx)
+        return [citylist[i] for i in cityidx]
 
-        return subcities
-            
+    def _getGridCells(self,x,xmin,xmax,xdim,ncells):
+        """
+        Find the cells of a row (or column) of grid cells that contain a set of coordinates.
+
+        Cell edges are computed exactly as xmin + i*xdim, so that coordinates lying on an edge
+        are found in both of the cells that share it.
+        @param x: Array of coordinates.
+        @param xmin: Lower edge of the first cell.
+        @param xmax: Upper edge of the last cell (if it lies beyond xmin + ncells*xdim).
+        @param xdim: Cell size.
+        @param ncells: Number of cells.
+        @return: List of (indices,cells) tuples, where indices is a sorted integer array of the
+                 coordinates inside a cell, and cells is the index of that cell.
+        """
+        cell = clip(floor((x - xmin)/xdim),0,ncells-1).astype(intp)
+        cells = []
+        for offset in (-1,0,1):
+            tcell = cell + offset
+            cmin = xmin + tcell*xdim
+            cmax = cmin + xdim
+            cmax = where(tcell == ncells-1,maximum(cmax,xmax),cmax)
+            inside = (tcell >= 0) & (tcell < ncells) & (x >= cmin) & (x <= cmax)
+            idx = flatnonzero(inside)
+            cells.append((idx,tcell[idx]))
+        return cells
             
     def findCitiesByRadius(self,lat,lon,radius,citylist=None):
         """
@@ -78,6 +228,9 @@ class PagerCity:
                            - pop    Population of city.
         @return: List of city dictionaries (same fields as input citylist).
         """
+        if citylist == None and self.store is not None:
+            idx,dist = self.store.getSpatialIndex().queryRadius(lat,lon,radius*1000)
+            return self._getCities(idx)
         subcities = []
         if citylist == None:
             citylist = self.cities
@@ -87,6 +240,58 @@ class PagerCity:
 
         return subcities
 
+    def findNearestCities(self,lat,lon,k,minpop=0,capitals_only=False,citylist=None,format='short'):
+        """
+        Find the k cities nearest to a point, with distance and direction from each city to the point.
+        @param lat:  Latitude of search point (i.e., epicenter).
+        @param lon:  Longitude of search point.
+        @param k: Maximum number of cities to return.
+        @keyword minpop: Minimum population of cities to consider.
+        @keyword capitals_only: Boolean indicating whether only capitals should be considered.
+        @keyword citylist: List of city dictionaries to search from:
+                           - name   City name
+                           - ccode  Two-letter country code.
+                           - lat    Latitude of city center.
+                           - lon    Longitude of city center.
+                           - iscap  Boolean indicating if city is a capital of a region or country.
+                           - pop    Population of city.
+        @keyword format: Compass direction format ('short' or 'long', see neicmap.distance.getCompassDir).
+        @return: Tuple of (cities,distance,azimuth,direction), ordered from nearest to farthest:
+                 - cities     List of (at most k) city dictionaries (same fields as input citylist).
+                 - distance   Numpy array of distances (km) from each city to the search point.
+                 - azimuth    Numpy array of azimuths (degrees) from each city to the search point.
+                 - direction  Numpy array of compass directions from each city to the search point,
+                              so that a city and its direction read as "10 km SW of City".
+        """
+        if citylist == None and self.store is not None:
+            mask = None
+            if minpop > 0 or capitals_only:
+                mask = self.store.pop >= minpop
+                if capitals_only:
+                    mask = mask & self.store.iscap
+            idx,dist = self.store.getSpatialIndex().queryNearest(lat,lon,k,mask=mask)
+            cities = self._getCities(idx)
+            clat = self.store.lat[idx]
+            clon = self.store.lon[idx]
+        else:
+            if citylist == None:
+                citylist = self.cities
+            candidates = []
+            for city in citylist:
+                if city['pop'] >= minpop and (city['iscap'] or not capitals_only):
+                    candidates.append(city)
+            clat = array([city['lat'] for city in candidates],dtype=float64)
+            clon = array([city['lon'] for city in candidates],dtype=float64)
+            dist = sdist(lat,lon,clat,clon)
+            idx = argsort(dist,kind='mergesort')[0:k]
+            cities = [candidates[i] for i in idx]
+            dist = dist[idx]
+            clat = clat[idx]
+            clon = clon[idx]
+        azimuth = getAzimuth(clat,clon,lat,lon)
+        direction = getCompassDirFromAzimuth(azimuth,format=format)
+        return (cities,dist/1000.0,azimuth,direction)
+
     def findCitiesByRectangle(self,bounds,citylist=None):
         """
         Find cities inside a given rectangle.
@@ -104,6 +309,11 @@ class PagerCity:
         xmax = bounds[1]
         ymin = bounds[2]
         ymax = bounds[3]
+        if citylist == None and self.store is not None:
+            lat = self.store.lat
+            lon = self.store.lon
+            inside = (lat >= ymin) & (lat <= ymax) & (lon >= xmin) & (lon <= xmax)
+            return self._getCities(flatnonzero(inside))
         subcities = []
         if citylist == None:
             citylist = self.cities
@@ -126,6 +336,8 @@ class PagerCity:
                            - pop    Population of city.
         @return: List of city dictionaries (same fields as input citylist).
         """
+        if citylist == None and self.store is not None:
+            return self._getCities(self.store.getCountryCities(ccode,ranked=False))
         subcities = []
         if citylist == None:
             citylist = self.cities
@@ -135,6 +347,30 @@ class PagerCity:
 
         return subcities
         
+    def findTopCitiesByCountry(self,ccode,ncities=None,citylist=None):
+        """
+        Find the most prominent cities within a particular country.
+
+        When no citylist is given, the cities come from the city store's per-country partition
+        (see neicmap.citystore.CityStore.getCountryOrder()), which is already ranked.
+        @param ccode:  Two letter country code.
+        @keyword ncities: Maximum number of cities to return (all if None).
+        @keyword citylist: List of city dictionaries to search from:
+                           - name   City name
+                           - ccode  Two-letter country code.
+                           - lat    Latitude of city center.
+                           - lon    Longitude of city center.
+                           - iscap  Boolean indicating if city is a capital of a region or country.
+                           - pop    Population of city.
+        @return: List of city dictionaries (same fields as input citylist), capitals first, then
+                 by decreasing population.
+        """
+        if citylist == None and self.store is not None:
+            return self._getCities(self.store.getCountryCities(ccode)[0:ncities])
+        subcities = self.findCitiesByCountry(ccode,citylist)
+        order = self.getCitySortOrder(subcities,method='capital')[0:ncities]
+        return [subcities[i] for i in order]
+        
     def findCitiesByCapital(self,citylist=None):
         """
         Find cities that are capitals of a region or country.
@@ -147,6 +383,8 @@ class PagerCity:
                            - pop    Population of city.
         @return: List of city dictionaries (same fields as input citylist).
         """
+        if citylist == None and self.store is not None:
+            return self._getCities(flatnonzero(self.store.iscap))
         subcities = []
         if citylist == None:
             citylist = self.cities
@@ -170,6 +408,9 @@ class PagerCity:
                            - pop    Population of city.
         @return: List of city dictionaries (same fields as input citylist).
         """
+        if citylist == None and self.store is not None:
+            pop = self.store.pop
+            return self._getCities(flatnonzero((pop >= pop1) & (pop <= pop2)))
         subcities = []
         if citylist == None:
             citylist = self.cities
@@ -179,9 +420,12 @@ class PagerCity:
 
         return subcities
 
-    def getCityExposure(self,shakegrid,citylist=None):
+    def getCityExposure(self,shakegrid,citylist=None,method='nearest'):
         """
         Find cities that are within a given shakemap, add MMI to keys.
+
+        All city coordinates are converted to grid rows and columns at once, and the grid is
+        sampled in a single array operation.  The input city dictionaries are not modified.
         @param shakegrid: ShakeGrid object.
         @keyword citylist: List of city dictionaries to search from:
                            - name   City name
@@ -190,25 +434,86 @@ class PagerCity:
                            - lon    Longitude of city center.
                            - iscap  Boolean indicating if city is a capital of a region or country.
                            - pop    Population of city.
-        @return: List of city dictionaries, having the same fields as input citylist, with the addition of:
+        @keyword method: Grid sampling method, 'nearest' or 'linear' (see neicmap.exposure.GridSampler).
+        @return: List of city dictionaries (copies of those in citylist), having the same fields as input
+                 citylist, with the addition of:
                  - mmi    MMI value to which city was exposed.
         """
+        if citylist == None and self.store is not None:
+            sampler = GridSampler(shakegrid.geodict,self.store.lat,self.store.lon,method=method)
+            cities = self._getCities(sampler.points)
+        else:
+            if citylist == None:
+                citylist = self.cities
+            lat = array([city['lat'] for city in citylist],dtype=float64)
+            lon = array([city['lon'] for city in citylist],dtype=float64)
+            sampler = GridSampler(shakegrid.geodict,lat,lon,method=method)
+            cities = [citylist[i] for i in sampler.points]
+        mmi = sampler.sampleInside(shakegrid.griddata)
         subcities = []
+        for i in range(0,len(cities)):
+            city = cities[i].copy()
+            city['mmi'] = mmi[i]
+            subcities.append(city)
+        return subcities
+
+    def getCityExposureArray(self,shakegrid,method='nearest'):
+        """
+        Sample a shakemap at every city in the city store.
+        @param shakegrid: ShakeGrid object.
+        @keyword method: Grid sampling method, 'nearest' or 'linear' (see neicmap.exposure.GridSampler).
+        @return: Numpy array of MMI values aligned with the city store, NaN for cities outside the shakemap.
+        """
+        if self.store is None:
+            raise PagerCityError, 'getCityExposureArray requires cities loaded with loadCities().'
+        sampler = GridSampler(shakegrid.geodict,self.store.lat,self.store.lon,method=method)
+        return sampler.sample(shakegrid.griddata)
+        
+
+    def getCityExposureEnsemble(self,shakegrids,citylist=None,method='nearest'):
+        """
+        Find cities that are within a set of alternative shakemaps (i.e., a scenario ensemble),
+        and sample every shakemap at each of them.
+
+        The grid row/column of each city is computed once for all realizations that share a grid
+        geometry (see neicmap.exposure.getExposureMatrix()), and no city dictionary is modified.
+        Per-city summaries can be computed with neicmap.exposure.getExposurePercentiles().
+        @param shakegrids: Sequence of ShakeGrid objects.
+        @keyword citylist: List of city dictionaries to search from (see getCityExposure()).
+        @keyword method: Grid sampling method, 'nearest' or 'linear' (see neicmap.exposure.GridSampler).
+        @return: Tuple of (cities,mmi), where cities is the list of city dictionaries inside the
+                 first shakemap, and mmi is a float32 array with one row per city and one column
+                 per shakemap (NaN where a city is outside a shakemap with different bounds).
+        """
+        if citylist == None and self.store is not None:
+            points,mmi = getExposureMatrix(shakegrids,self.store.lat,self.store.lon,method=method)
+            return (self._getCities(points),mmi)
         if citylist == None:
             citylist = self.cities
+        lat = array([city['lat'] for city in citylist],dtype=float64)
+        lon = array([city['lon'] for city in citylist],dtype=float64)
+        points,mmi = getExposureMatrix(shakegrids,lat,lon,method=method)
+        return ([citylist[i] for i in points],mmi)
 
-        for city in citylist:
-            lat = city['lat']
-            lon = city['lon']
-            try:
-                mmi = shakegrid.getValue(lat,lon)
-                city['mmi'] = mmi
-                subcities.append(city)
-            except GridError: #lat,lon may be out of bounds...
-                continue
-
-        return subcities
-        
+    def getExposureSession(self,eventid,method='nearest'):
+        """
+        Return the exposure session for an event, creating it if necessary.
+
+        Sessions for the most recently used events are kept (see neicmap.exposure.ExposureSession),
+        so that each new ShakeMap version for an event can be processed incrementally:
+          session = pagercity.getExposureSession(eventid)
+          citytable = session.update(shakegrid)
+        @param eventid: Event ID string.
+        @keyword method: Grid sampling method, 'nearest' or 'linear' (see neicmap.exposure.GridSampler).
+        @return: ExposureSession object.
+        """
+        if self.store is None:
+            raise PagerCityError, 'getExposureSession requires cities loaded with loadCities().'
+        session = self.sessions.get((eventid,method))
+        if session is None:
+            session = ExposureSession(eventid,self,method=method)
+            self.sessions.put((eventid,method),session)
+        return session
 
     def getCityTable(self,citylist):
         """
@@ -221,6 +526,10 @@ class PagerCity:
         3. If N+M < 11, sort cities by inverse population, then select (up to) P= 11 - (M+N) cities that are not already in the list.  Combine
            list of P cities with list of N and list of M.
         4. Sort combined list of cities by inverse MMI and return.
+
+        Cities are "in the list" when they share a name with a city already selected.  Each step
+        selects its cities from arrays of sort keys without sorting the whole list, and citylist
+        itself is not modified.
         
         @param citylist:  List of city dictionaries from which to search, with at least the following keys:
                          - name   City name
@@ -234,66 +543,82 @@ class PagerCity:
         NMax = 6
         MMax = 5
         NTotal = 11
+        if len(citylist) == 0:
+            return []
+        if 'mmi' not in citylist[0].keys():
+            raise PagerCityError, 'Key "mmi" not in city dictionary list'
+        #sort keys, negated so that ascending order puts the best city first.  The last key is
+        #the primary one; the rest reproduce the tie-breaking of the successive stable sorts
+        #(MMI, then capital status, then population) done by earlier versions of this method.
+        ncities = len(citylist)
+        idx = arange(0,ncities)
+        mmi = -array([city['mmi'] for city in citylist],dtype=float64)
+        pop = -array([city['pop'] for city in citylist],dtype=int64)
+        iscap = -array([city['iscap'] for city in citylist],dtype=int8)
+        names = [city['name'] for city in citylist]
         #Step 1 - get at most 6 cities with highest MMI
-        mmicities = self.sortCities(citylist,method='mmi')
-        if len(mmicities) < NMax:
-            return mmicities
-        mmicities = citylist[0:NMax]
-        #Step 2 - get at most 5 cities that are capitals
-        capcities,citylist = self.removeDuplicateCities(citylist,mmicities,'capital',MMax)
-        capcities2 = []
-        for city in capcities:
-            if city['iscap']:
-                capcities2.append(city)
-        combined_cities = mmicities + capcities2
-        if len(combined_cities) == NTotal:
-            return self.sortCities(combined_cities,method='mmi')
-                
-        #Step 3 - Fill out list with top cities by population
-        ncities = len(combined_cities)
-        popcities,citylist = self.removeDuplicateCities(citylist,combined_cities,'population',NTotal-ncities)
-        combined_cities = combined_cities + popcities
-        
-        #Step 4 - Sort list by MMI, return
-        return self.sortCities(combined_cities,method='mmi')
-        
+        mmiidx = self._selectTopCities([idx,mmi],NMax,idx)
+        if ncities < NMax:
+            return [citylist[i] for i in mmiidx]
+        #Step 2 - get at most 5 cities that are capitals, skipping cities named like those already selected
+        excluded = set([names[i] for i in mmiidx])
+        candidates = array([i for i in idx if names[i] not in excluded],dtype=intp)
+        capidx = self._selectTopCities([idx,mmi,pop,iscap],MMax,candidates)
+        capidx = capidx[iscap[capidx] < 0]
+        tableidx = concatenate((mmiidx,capidx))
+        if len(tableidx) < NTotal:
+            #Step 3 - Fill out list with top cities by population
+            excluded.update([names[i] for i in capidx])
+            candidates = array([i for i in candidates if names[i] not in excluded],dtype=intp)
+            popidx = self._selectTopCities([idx,mmi,iscap,pop],NTotal-len(tableidx),candidates)
+            tableidx = concatenate((tableidx,popidx))
+        #Step 4 - Sort list by MMI (stable, so ties keep the order in which cities were selected), return
+        tableidx = tableidx[lexsort((arange(0,len(tableidx)),mmi[tableidx]))]
+        return [citylist[i] for i in tableidx]
+
+    def _selectTopCities(self,keys,k,candidates):
+        """
+        Select the first k candidate cities in the order defined by a set of sort keys.
+
+        Only the candidates that tie with or beat the k-th value of the primary key are sorted,
+        so selecting a few cities from a long list takes linear rather than N log N time.
+        @param keys: Sequence of (ascending) key arrays indexed by city, as for numpy.lexsort(); the
+                     last key is the primary one, and the first should be unique to break all ties.
+        @param k: Number of cities to select.
+        @param candidates: Integer array of indices of the cities to select from.
+        @return: Integer array of (at most k) selected city indices, in sorted order.
+        """
+        if len(candidates) > k:
+            primary = keys[-1][candidates]
+            kth = partition(primary,k-1)[k-1]
+            candidates = candidates[primary <= kth]
+        order = lexsort([key[candidates] for key in keys])
+        return candidates[order[0:k]]
         
     def removeDuplicateCities(self,allcities,citylist1,method,maxlen):
         """
         Return a list (of maxlen or less) of sorted cities selected from allcities that does not intersect with citylist1.
 
+        Cities are compared by name, so every city in allcities named like a city in citylist1 is removed.
         @param allcities:  Large list of cities from which to search and sort.
         @param citylist1:  List against which selected sorted cities should be compared for duplicates.
         @param method:   Method by which selected cities should be sorted.
         @param maxlen:   Maximum length of list of selected sorted cities.
         @return: Two element tuple of selected cities and modified list of allcities (with duplicates removed).
         """
-        c1names = [city['name'] for city in citylist1]
-        citylist2 = self.sortCities(allcities,method=method)
-        allnames = [city['name'] for city in allcities]
-        c2names = [city['name'] for city in citylist2]
-        
-
-        dupcities = list(Set(c1names).intersection(c2names))
-        while len(dupcities) > 0:
-            for dup in dupcities:
-                dupidx = allnames.index(dup)
-                allcities.pop(dupidx)
-                allnames = [city['name'] for city in allcities]
-            citylist2 = self.sortCities(allcities,method=method)
-            allnames = [city['name'] for city in allcities]
-            c2names = [city['name'] for city in citylist2]
-            dupcities = list(Set(c1names).intersection(c2names))
-        
-        if len(citylist2) > maxlen:
-            citylist2 = citylist2[0:maxlen]
-        return (citylist2,allcities)
+        c1names = set([city['name'] for city in citylist1])
+        self.sortCities(allcities,method=method)
+        allcities[:] = [city for city in allcities if city['name'] not in c1names]
+        return (allcities[0:maxlen],allcities)
 
         
     def sortCities(self,citylist,method=None):
         """
-        Given a list of cities, sort them by one of N methods.
+        Given a list of cities, sort them (in place) by one of N methods.
 
+        The sort is stable, so cities that tie keep their order in citylist.  The sort order is
+        computed by getCitySortOrder(), which should be used instead when the input list must not
+        be modified.
         @param citylist: List of city dictionaries, with at least the following keys:
                          - name   City name
                          - ccode  Two-letter country code.
@@ -302,36 +627,65 @@ class PagerCity:
                          - iscap  Boolean indicating if city is a capital of a region or country.
                          - pop    Population of city.
         @keyword method: String indicating which sorting method to use:
+                         - None - Sort by city population
                          - 'population' - Sort by inverse city population
-                         - 'capital' - Sort by inverse capital status.
+                         - 'capital' - Sort by inverse capital status (then inverse population).
                          - 'mmi' - Sort by inverse MMI.
-                         - 'pager' - Use PAGER algorithm to determine list of (at most) 11 cities.
         @return: List of city dictionaries (see input).
         """
         if len(citylist) == 0:
             return citylist
+        order = self.getCitySortOrder(citylist,method=method)
+        citylist[:] = [citylist[i] for i in order]
+        return citylist
+
+    def getCitySortOrder(self,citylist=None,method=None):
+        """
+        Return the order in which sortCities() would put a list of cities, without sorting it.
+
+        Sort keys are gathered into arrays once and sorted in a single call to numpy.lexsort().
+        @keyword citylist: List of city dictionaries (see sortCities()).  If None, all cities in the
+                           city store are sorted.
+        @keyword method: Sorting method (see sortCities()).
+        @return: Integer array of indices into citylist (or the city store), in sorted order.
+        """
+        return lexsort(self._getSortKeys(citylist,method))
+
+    def _getSortKeys(self,citylist,method):
+        """
+        Return the numpy.lexsort() keys that put cities in sortCities() order.
+        @param citylist: List of city dictionaries, or None to use the city store.
+        @param method: Sorting method (see sortCities()).
+        @return: List of key arrays (primary key last), the first of which is the city position,
+                 so that ties keep their original order.
+        """
+        if citylist == None and self.store is not None:
+            ncities = len(self.store)
+        else:
+            if citylist == None:
+                citylist = self.cities
+            ncities = len(citylist)
+        def getColumn(key,dtype):
+            if citylist == None:
+                if not hasattr(self.store,key):
+                    raise PagerCityError, 'Key "%s" not in city store' % key
+                return getattr(self.store,key).astype(dtype)
+            if ncities and key not in citylist[0].keys():
+                raise PagerCityError, 'Key "%s" not in city dictionary list' % key
+            return array([city[key] for city in citylist],dtype=dtype)
+        keys = [arange(0,ncities)]
         if method==None:
-            citylist.sort(self.sortCitiesByPopulation)
-            return citylist
+            keys.append(getColumn('pop',int64))
+            return keys
         method = method.lower()
-        if method == 'mmi' and 'mmi' not in citylist[0].keys():
-            raise PagerCityError, 'Key "mmi" not in city dictionary list'
-
-        popmatch = re.compile('pop')
-        capmatch = re.compile('cap')
-        
-        haspop = popmatch.search(method)
-        hascap = capmatch.search(method)
-        if hascap:
-            citylist.sort(self.sortCitiesByCapital,reverse=True)
-            return citylist
-        elif haspop:
-            citylist.sort(self.sortCitiesByPopulation,reverse=True)
-            return citylist
+        if method.find('cap') > -1:
+            keys.append(-getColumn('pop',int64))
+            keys.append(-getColumn('iscap',int8))
+        elif method.find('pop') > -1:
+            keys.append(-getColumn('pop',int64))
         else:
-            citylist.sort(self.sortCitiesByMMI,reverse=True)
-
-        return citylist
+            keys.append(-getColumn('mmi',float64))
+        return keys
 
     def formatCityList(self,citylist,ncities):
         if len(citylist) == 0:
@@ -414,51 +768,80 @@ class PagerCity:
 
 
 
-    def loadCities(self,cityfile):
-        #     1)geonameid         : integer id of record in geonames database
-        #     2)name              : name of geographical point (utf8) varchar(200)
-        #     3)asciiname         : name of geographical point in plain ascii characters, varchar(200)
-        #     4)alternatenames    : alternatenames, comma separated varchar(4000)
-        #     5)latitude          : latitude in decimal degrees (wgs84)
-        #     6)longitude         : longitude in decimal degrees (wgs84)
-        #     7)feature class     : see http://www.geonames.org/export/codes.html, char(1)
-        #     8)feature code      : see http://www.geonames.org/export/codes.html, varchar(10)
-        #     9)country code      : ISO-3166 2-letter country code, 2 characters
-        #     10)cc2              : alternate country codes, comma separated, ISO-3166 2-letter country code, 60 characters
-        #     11)admin1 code      : fipscode (subject to change to iso
-        #                           code), isocode for the us and ch, see file
-        #                           admin1Codes.txt for display names of this code; varchar(20)
-        #     12)admin2 code      : code for the second administrative
-        #                           division, a county in the US, see file admin2Codes.txt;varchar(80)
-        #     13)admin3 code      : code for third level administrative division, varchar(20)
-        #     14)admin4 code      : code for fourth level administrative division, varchar(20)
-        #     15)population       : integer 
-        #     16)elevation        : in meters, integer
-        #     17)gtopo30          : average elevation of 30'x30' (ca 900mx900m) area in meters, integer
-        #     18)timezone         : the timezone id (see file timeZone.txt)
-        #     19)modification date: date of last modification in yyyy-MM-dd format
-        CAPFLAG1 = 'PPLC'
-        CAPFLAG2 = 'PPLA'
-        tmpcities = []
-        self.cities = []
+    def loadCities(self,cityfile,columnar=False,usecache=True,cachefile=None,
+                   bounds=None,ccodes=None,minpop=None,fcodes=None,asciionly=True):
+        """
+        Load cities from a GeoNames cities file into the city store.
+
+        Parsed cities are saved to a binary cache file, which later loads of the same (unmodified)
+        city file memory-map instead of parsing the text file again.  If the cache cannot be
+        written (i.e., the directory is read-only), the city file is simply parsed each time.
+        When any of the filter keywords are used, the cache is only read and written if cachefile
+        is given explicitly.
+        @param cityfile: cities1000.txt file from the GeoNames website.
+        @keyword columnar: If True, do not build the list of city dictionaries (see __init__).
+        @keyword usecache: Boolean indicating whether the binary cache should be read and written.
+        @keyword cachefile: Path to the binary cache file (defaults to cityfile + '.cache').
+        @keyword bounds: Sequence of [lonmin,lonmax,latmin,latmax]; only cities inside are loaded.
+        @keyword ccodes: Sequence of two-letter country codes; only cities in these countries are loaded.
+        @keyword minpop: Minimum population of cities to load.
+        @keyword fcodes: Sequence of GeoNames feature codes; only cities with these codes are loaded.
+        @keyword asciionly: Boolean indicating whether cities with non-ASCII names should be skipped.
+        """
         if not os.path.isfile(cityfile):
             raise PagerCityError, 'Could not find specified city file %s.' % (cityfile)
-        f = open(cityfile,'rt')
-        for line in f.readlines():
-            city = {}
-            parts = line.split('\t')
-            city['name'] = parts[2].strip()
-            city['ccode'] = parts[8].strip()
-            city['lat'] = float(parts[4].strip())
-            city['lon'] = float(parts[5].strip())
-            city['iscap'] = (parts[7].strip() == CAPFLAG1 or parts[7] == CAPFLAG2)
-            city['pop'] = int(parts[14].strip())
-            if not city['name']:
-                #print 'Found a city with no name'
-                continue
-            myvals = array([ord(c) for c in city['name']])
-            if len((myvals > 127).nonzero()[0]):
-                #print '%s' % parts[0]
-                continue
-            self.cities.append(city)
-        f.close()
+        filters = (bounds,ccodes,minpop,fcodes,asciionly)
+        isfiltered = filters != (None,None,None,None,True)
+        if isfiltered and cachefile is None:
+            usecache = False
+        store = None
+        storefile = None
+        if usecache:
+            if cachefile is None:
+                cachefile = cityfile + '.cache'
+            sourcekey = getSourceKey(cityfile)
+            if isfiltered:
+                sourcekey = sourcekey + ' ' + repr(filters).replace(' ','')
+            try:
+                store = CityStore.load(cachefile,sourcekey=sourcekey)
+                storefile = cachefile
+            except CityStoreError:
+                pass
+        if store is None:
+            store = readCityFile(cityfile,bounds=bounds,ccodes=ccodes,minpop=minpop,
+                                 fcodes=fcodes,asciionly=asciionly)
+            if usecache:
+                try:
+                    store.save(cachefile,sourcekey=sourcekey)
+                    storefile = cachefile
+                except (IOError,OSError):
+                    pass
+        self._setStore(store,columnar,storefile)
+
+    def loadCityCache(self,cachefile,columnar=False):
+        """
+        Load cities directly from a binary city cache file, without checking it against a city file.
+        @param cachefile: Path to a cache file written by loadCities() (or CityStore.save()).
+        @keyword columnar: If True, do not build the list of city dictionaries (see __init__).
+        """
+        try:
+            store = CityStore.load(cachefile)
+        except CityStoreError,msg:
+            raise PagerCityError, msg.args[0]
+        self._setStore(store,columnar,cachefile)
+
+    def _setStore(self,store,columnar,cachefile):
+        """
+        Make a CityStore the source of all city searches.
+        @param store: CityStore object.
+        @param columnar: If True, do not build the list of city dictionaries (see __init__).
+        @param cachefile: Path to the cache file holding the store, or None.
+        """
+        self.store = store
+        self.cachefile = cachefile
+        self._nameindex = None
+        self.sessions.clear()
+        if columnar:
+            self._cities = None
+        else:
+            self._cities = self.store.getCities()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+import numpy
+from neicmap.distance import sdist
+
+class CityQueryError(Exception):
+    """Used to handle errors for CityQuery"""
+    def __str__(self):
+        return repr(self.args[0])
+
+class CityQuery(object):
+    """
+    Lazy, composable search over a CityStore (see PagerCity.query()).
+
+    Each filter method returns a new CityQuery with one more predicate, and nothing is searched
+    until results are requested:
+      q = pagercity.query().withinRadius(35.7,139.7,200).country('JP').population(1e5,None).capitals()
+      cities = q.orderBy('capital').limit(10).getCities()
+    When results are requested, one predicate is answered from an index (a country from the
+    store's country partition, otherwise a radius from the spatial index), and all the others
+    are combined into a single vectorized mask over the cities that index returned.
+    """
+    def __init__(self,store,cities=None):
+        """
+        Create a CityQuery matching every city in a store.
+        @param store: CityStore object.
+        @keyword cities: List of city dictionaries aligned with store, from which results are
+                         taken.  If None, result dictionaries are built from the store.
+        """
+        self.store = store
+        self.cities = cities
+        self.predicates = []
+        self.sortmethod = None
+        self.maxcities = None
+
+    def _extend(self,**kwargs):
+        query = CityQuery(self.store,self.cities)
+        query.predicates = list(self.predicates)
+        query.sortmethod = self.sortmethod
+        query.maxcities = self.maxcities
+        for key,value in kwargs.items():
+            if key == 'predicate':
+                query.predicates.append(value)
+            else:
+                setattr(query,key,value)
+        return query
+
+    def withinRadius(self,lat,lon,radius):
+        """
+        Keep cities inside a search radius (see PagerCity.findCitiesByRadius()).
+        @param lat:  Latitude of center of search radius.
+        @param lon:  Longitude of center of search radius.
+        @param radius: Radius (in km) within which search should be conducted.
+        @return: New CityQuery.
+        """
+        return self._extend(predicate=('radius',(lat,lon,radius)))
+
+    def withinRectangle(self,bounds):
+        """
+        Keep cities inside a rectangle (see PagerCity.findCitiesByRectangle()).
+        @param bounds:  Sequence of [lonmin,lonmax,latmin,latmax].
+        @return: New CityQuery.
+        """
+        return self._extend(predicate=('rectangle',tuple(bounds)))
+
+    def country(self,ccode):
+        """
+        Keep cities within a particular country.
+        @param ccode:  Two letter country code (case-insensitive).
+        @return: New CityQuery.
+        """
+        return self._extend(predicate=('country',ccode))
+
+    def population(self,pop1=None,pop2=None):
+        """
+        Keep cities with a population between two (inclusive) bracketing values.
+        @keyword pop1: Minimum population threshold, or None for no minimum.
+        @keyword pop2: Maximum population threshold, or None for no maximum.
+        @return: New CityQuery.
+        """
+        return self._extend(predicate=('population',(pop1,pop2)))
+
+    def capitals(self):
+        """
+        Keep cities that are capitals of a region or country.
+        @return: New CityQuery.
+        """
+        return self._extend(predicate=('capital',None))
+
+    def orderBy(self,method):
+        """
+        Order results by one of the PagerCity.sortCities() methods ('population' or 'capital').
+        @param method: Sorting method, or None for store order.
+        @return: New CityQuery.
+        """
+        return self._extend(sortmethod=method)
+
+    def limit(self,ncities):
+        """
+        Return at most a given number of results (the first in result order).
+        @param ncities: Maximum number of cities.
+        @return: New CityQuery.
+        """
+        return self._extend(maxcities=ncities)
+
+    def _getCandidates(self):
+        """
+        Answer one predicate from an index.
+        @return: Tuple of (indices,predicate): a sorted integer array of the cities matching
+                 predicate, or (None,None) if no predicate can use an index.
+        """
+        for predicate in self.predicates:
+            if predicate[0] == 'country':
+                return (self.store.getCountryCities(predicate[1],ranked=False),predicate)
+        for predicate in self.predicates:
+            if predicate[0] == 'radius':
+                lat,lon,radius = predicate[1]
+                idx,dist = self.store.getSpatialIndex().queryRadius(lat,lon,radius*1000)
+                return (idx,predicate)
+        return (None,None)
+
+    def getIndices(self):
+        """
+        Run the query.
+        @return: Integer array of indices of matching cities in the store, in result order.
+        """
+        store = self.store
+        idx,indexed = self._getCandidates()
+        def getColumn(name):
+            column = getattr(store,name)
+            if idx is None:
+                return column
+            return column[idx]
+        mask = None
+        for predicate in self.predicates:
+            if predicate is indexed:
+                continue
+            kind,args = predicate
+            if kind == 'radius':
+                lat,lon,radius = args
+                tmask = sdist(lat,lon,getColumn('lat'),getColumn('lon')) <= radius*1000
+            elif kind == 'rectangle':
+                xmin,xmax,ymin,ymax = args
+                lat = getColumn('lat')
+                lon = getColumn('lon')
+                tmask = (lat >= ymin) & (lat <= ymax) & (lon >= xmin) & (lon <= xmax)
+            elif kind == 'country':
+                groups = store.getCountryGroups()
+                if idx is not None:
+                    groups = groups[idx]
+                tmask = groups == store.getCountryGroup(args)
+            elif kind == 'population':
+                pop1,pop2 = args
+                pop = getColumn('pop')
+                tmask = numpy.ones(len(pop),dtype=numpy.bool_)
+                if pop1 is not None:
+                    tmask &= pop >= pop1
+                if pop2 is not None:
+                    tmask &= pop <= pop2
+            elif kind == 'capital':
+                tmask = getColumn('iscap')
+            if mask is None:
+                mask = tmask.copy()
+            else:
+                mask &= tmask
+        if idx is None:
+            idx = numpy.arange(0,len(store))
+        if mask is not None:
+            idx = idx[mask]
+        if self.sortmethod is not None:
+            idx = idx[numpy.lexsort([key[idx] for key in self._getSortKeys(self.sortmethod)])]
+        if self.maxcities is not None:
+            idx = idx[0:self.maxcities]
+        return idx
+
+    def _getSortKeys(self,method):
+        """
+        Return numpy.lexsort() keys over the whole store for a sorting method (see PagerCity.sortCities()).
+        """
+        store = self.store
+        keys = [numpy.arange(0,len(store))]
+        method = method.lower()
+        if method.find('cap') > -1:
+            keys.append(-store.pop)
+            keys.append(-store.iscap.astype(numpy.int8))
+        elif method.find('pop') > -1:
+            keys.append(-store.pop)
+        else:
+            raise CityQueryError, 'Cannot sort cities by "%s"' % method
+        return keys
+
+    def getCities(self):
+        """
+        Run the query.
+        @return: List of matching city dictionaries, in result order.
+        """
+        idx = self.getIndices()
+        if self.cities is None:
+            return self.store.getCities(idx)
+        return [self.cities[i] for i in idx]
+
+    def count(self):
+        """
+        Run the query.
+        @return: Number of matching cities.
+        """
+        return len(self.getIndices())
@@ -0,0 +1,444 @@
+#!/usr/bin/python
+import os
+import os.path
+import array
+import numpy
+from neicmap.spatial import SphericalIndex
+from neicmap.nameindex import CityNameIndex
+
+#version of the binary city cache file format; bump whenever the layout or the parsing rules change
+CACHE_VERSION = 1
+CACHE_MAGIC = 'NEICMAP-CITYSTORE'
+CACHE_HEADER_SIZE = 4096
+CACHE_ALIGN = 64
+
+class CityStoreError(Exception):
+    """Used to handle errors for CityStore"""
+    def __str__(self):
+        return repr(self.args[0])
+
+def getSourceKey(filename):
+    """
+    Return a string identifying the current version of a source file, by size and modification time.
+    @param filename: Path to source file.
+    @return: String key; changes whenever the source file is modified or replaced.
+    """
+    st = os.stat(filename)
+    return '%i:%r' % (st.st_size,st.st_mtime)
+
+class CityStore(object):
+    """
+    Columnar (array-backed) storage for a set of cities.
+
+    Each city attribute is held in a single NumPy array, rather than in one dictionary per city:
+     - lat    Latitude of city center (float64).
+     - lon    Longitude of city center (float64).
+     - pop    Population of city (int64).
+     - iscap  Boolean indicating if city is a capital of a region or country.
+     - cidx   Index into ccodes table of the city's two-letter country code (int16).
+     - ccodes Sorted table of unique two-letter country codes.
+     - namebuf/nameoff  Name table: city names concatenated into a single byte array, with
+                        the name of city i stored in namebuf[nameoff[i]:nameoff[i+1]].
+    """
+    def __init__(self,names,ccodes,lat,lon,pop,iscap):
+        """
+        Construct a CityStore from sequences of city attributes.
+        @param names: Sequence of city names.
+        @param ccodes: Sequence of two-letter country codes.
+        @param lat: Sequence of city latitudes.
+        @param lon: Sequence of city longitudes.
+        @param pop: Sequence of city populations.
+        @param iscap: Sequence of booleans indicating capital status.
+        """
+        self.lat = numpy.array(lat,dtype=numpy.float64)
+        self.lon = numpy.array(lon,dtype=numpy.float64)
+        self.pop = numpy.array(pop,dtype=numpy.int64)
+        self.iscap = numpy.array(iscap,dtype=numpy.bool_)
+        ccodes = numpy.array(ccodes,dtype='S2')
+        if len(ccodes):
+            self.ccodes,cidx = numpy.unique(ccodes,return_inverse=True)
+        else:
+            self.ccodes,cidx = ccodes,numpy.zeros(0)
+        self.cidx = cidx.astype(numpy.int16)
+        lengths = numpy.array([len(name) for name in names],dtype=numpy.int64)
+        self.nameoff = numpy.zeros(len(lengths)+1,dtype=numpy.int64)
+        self.nameoff[1:] = lengths.cumsum()
+        self.namebuf = numpy.frombuffer(''.join(names),dtype=numpy.uint8)
+        self._index = None
+        self._nameindex = None
+        self._countryorder = None
+        self._countrygroups = None
+
+    #names of the array attributes that make up a CityStore, in the order they are written to a cache file
+    COLUMNS = ['lat','lon','pop','iscap','cidx','ccodes','nameoff','namebuf']
+
+    @classmethod
+    def fromColumns(cls,columns):
+        """
+        Construct a CityStore directly from its column arrays, without copying them.
+        @param columns: Dictionary of arrays, keyed by the names in CityStore.COLUMNS.
+        @return: CityStore object.
+        """
+        store = cls.__new__(cls)
+        for column in cls.COLUMNS:
+            setattr(store,column,columns[column])
+        store._index = None
+        store._nameindex = None
+        store._countryorder = None
+        store._countrygroups = None
+        return store
+
+    def save(self,filename,sourcekey=''):
+        """
+        Write the CityStore to a flat binary cache file that can be memory-mapped by load().
+
+        The file is written to a temporary name and then renamed, so that readers never see
+        a partially written cache.
+        @param filename: Path to cache file.
+        @keyword sourcekey: String identifying the source the store was built from (see getSourceKey()).
+        """
+        header = ['%s %i' % (CACHE_MAGIC,CACHE_VERSION),'source %s' % sourcekey]
+        offset = CACHE_HEADER_SIZE
+        for column in self.COLUMNS:
+            data = getattr(self,column)
+            header.append('array %s %s %i %i' % (column,data.dtype.str,offset,len(data)))
+            offset += data.nbytes
+            offset += -offset % CACHE_ALIGN
+        header.append('end\n')
+        header = '\n'.join(header)
+        if len(header) > CACHE_HEADER_SIZE:
+            raise CityStoreError, 'Cache header for source "%s" is too long.' % (sourcekey)
+        tmpfile = '%s.%i.tmp' % (filename,os.getpid())
+        try:
+            f = open(tmpfile,'wb')
+            try:
+                f.write(header.ljust(CACHE_HEADER_SIZE,'\0'))
+                for column in self.COLUMNS:
+                    data = numpy.ascontiguousarray(getattr(self,column))
+                    f.write(data.tostring())
+                    f.write('\0' * (-f.tell() % CACHE_ALIGN))
+            finally:
+                f.close()
+            os.rename(tmpfile,filename)
+        except:
+            #do not leave a partial cache file behind (i.e., when the disk is full)
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+    @classmethod
+    def load(cls,filename,sourcekey=None):
+        """
+        Load a CityStore from a binary cache file written by save().
+
+        The column arrays are read-only memory maps of the cache file, so processes that load
+        the same cache share its pages instead of holding private copies.
+        @param filename: Path to cache file.
+        @keyword sourcekey: If not None, the source key the cache must have been written with.
+        @return: CityStore object.
+        @raise CityStoreError: When the file is not a cache, was written by a different version
+                               of this module, or does not match sourcekey.
+        """
+        if not os.path.isfile(filename):
+            raise CityStoreError, 'Could not find specified cache file %s.' % (filename)
+        f = open(filename,'rb')
+        header = f.read(CACHE_HEADER_SIZE).rstrip('\0').split('\n')
+        f.close()
+        if header[0] != '%s %i' % (CACHE_MAGIC,CACHE_VERSION):
+            raise CityStoreError, 'File %s is not a version %i city cache.' % (filename,CACHE_VERSION)
+        if sourcekey is not None and header[1] != 'source %s' % sourcekey:
+            raise CityStoreError, 'City cache %s is out of date.' % (filename)
+        filesize = os.path.getsize(filename)
+        columns = {}
+        for line in header[2:]:
+            parts = line.split()
+            if not parts or parts[0] != 'array':
+                continue
+            column,dtype,offset,count = parts[1],parts[2],int(parts[3]),int(parts[4])
+            if offset + count*numpy.dtype(dtype).itemsize > filesize:
+                raise CityStoreError, 'City cache %s is truncated.' % (filename)
+            if count == 0:
+                columns[column] = numpy.zeros(0,dtype=dtype)
+            else:
+                data = numpy.memmap(filename,dtype=dtype,mode='r',offset=offset,shape=(count,))
+                columns[column] = data.view(numpy.ndarray)
+        if sorted(columns.keys()) != sorted(cls.COLUMNS):
+            raise CityStoreError, 'City cache %s is missing columns.' % (filename)
+        return cls.fromColumns(columns)
+
+    @classmethod
+    def fromCityList(cls,citylist):
+        """
+        Construct a CityStore from a list of city dictionaries.
+        @param citylist: List of city dictionaries, with at least the following keys:
+                         - name   City name
+                         - ccode  Two-letter country code.
+                         - lat    Latitude of city center.
+                         - lon    Longitude of city center.
+                         - iscap  Boolean indicating if city is a capital of a region or country.
+                         - pop    Population of city.
+        @return: CityStore object.
+        """
+        return cls([city['name'] for city in citylist],
+                   [city['ccode'] for city in citylist],
+                   [city['lat'] for city in citylist],
+                   [city['lon'] for city in citylist],
+                   [city['pop'] for city in citylist],
+                   [city['iscap'] for city in citylist])
+
+    def __len__(self):
+        return len(self.lat)
+
+    @property
+    def ccode(self):
+        """Array of two-letter country codes, one per city."""
+        return self.ccodes[self.cidx]
+
+    def getSpatialIndex(self):
+        """
+        Return the spatial index over city locations, building it on first use.
+        @return: SphericalIndex object (see neicmap.spatial).
+        """
+        if self._index is None:
+            self._index = SphericalIndex(self.lat,self.lon)
+        return self._index
+
+    def getNameIndex(self):
+        """
+        Return the index over city names, building it on first use.
+        @return: CityNameIndex object (see neicmap.nameindex).
+        """
+        if self._nameindex is None:
+            self._nameindex = CityNameIndex(self.getNames(),self.pop)
+        return self._nameindex
+
+    def getCountryOrder(self,ranked=True):
+        """
+        Return the cities partitioned by country, computing the partition on first use.
+
+        Country codes are grouped case-insensitively (see getCountryGroups()), so cities coded
+        'US' and 'us' share a partition.  Two orderings of each country's cities are kept, sharing
+        one offsets table: store order, and ranked capitals first, then by decreasing population
+        (ties in store order), so that the first cities of a ranked slice are the country's most
+        prominent.
+        @keyword ranked: If True, return the ranked ordering, otherwise store order.
+        @return: Tuple of (order,offsets), where order is an integer array of city indices grouped
+                 by country, and the cities of country group i (see getCountryGroup()) are
+                 order[offsets[i]:offsets[i+1]].
+        """
+        if self._countryorder is None:
+            groupindex,groups,firstindex = self._getCountryGroupTable()
+            ngroups = len(groupindex)
+            rankorder = numpy.lexsort((numpy.arange(0,len(self)),-self.pop,~self.iscap,groups))
+            storeorder = numpy.argsort(groups,kind='mergesort')
+            counts = numpy.bincount(groups,minlength=ngroups)
+            offsets = numpy.zeros(ngroups+1,dtype=numpy.intp)
+            offsets[1:] = counts.cumsum()
+            self._countryorder = (rankorder,storeorder,offsets)
+        rankorder,storeorder,offsets = self._countryorder
+        if ranked:
+            return (rankorder,offsets)
+        return (storeorder,offsets)
+
+    def getCountryCities(self,ccode,ranked=True):
+        """
+        Return the indices of the cities in a country, as a slice of the country partition (see getCountryOrder()).
+        @param ccode: Two letter country code (case-insensitive).
+        @keyword ranked: If True, return the most prominent cities first, otherwise return them in store order.
+        @return: Integer array of city indices (empty if no city has that country code).
+        """
+        i = self.getCountryGroup(ccode)
+        order,offsets = self.getCountryOrder(ranked=ranked)
+        if i < 0:
+            return order[0:0]
+        return order[offsets[i]:offsets[i+1]]
+
+    def _getCountryGroupTable(self):
+        """
+        Build the case-insensitive country groups on first use.
+        @return: Tuple of (groupindex,citygroups,firstindex): a dictionary mapping upper case
+                 country codes to group indices, an integer array of the group index of each city,
+                 and a dictionary mapping upper case country codes to their first index in ccodes.
+        """
+        if self._countrygroups is None:
+            groupcodes = sorted(set([ccode.upper() for ccode in self.ccodes]))
+            groupindex = {}
+            for i in range(0,len(groupcodes)):
+                groupindex[groupcodes[i]] = i
+            firstindex = {}
+            for i in range(0,len(self.ccodes)):
+                firstindex.setdefault(self.ccodes[i].upper(),i)
+            cidxgroups = numpy.array([groupindex[ccode.upper()] for ccode in self.ccodes],dtype=numpy.intp)
+            self._countrygroups = (groupindex,cidxgroups[self.cidx],firstindex)
+        return self._countrygroups
+
+    def getCountryGroups(self):
+        """
+        Return the case-insensitive country group of every city.
+
+        Groups are numbered in order of their upper case country codes, so stores whose codes are
+        all upper case (as in GeoNames files) have one group per entry of ccodes.
+        @return: Integer array of country group indices, one per city.
+        """
+        return self._getCountryGroupTable()[1]
+
+    def getCountryGroup(self,ccode):
+        """
+        Return the case-insensitive country group of a two-letter country code.
+        @param ccode: Two letter country code.
+        @return: Integer country group index (see getCountryGroups()), or -1 if no city has that country code.
+        """
+        return self._getCountryGroupTable()[0].get(ccode.upper(),-1)
+
+    def getCountryIndex(self,ccode):
+        """
+        Return the index into the ccodes table of a (case-insensitive) two-letter country code.
+
+        Where the table holds several case variants of a code, the first is returned; use
+        getCountryGroup() to match all of them.
+        @param ccode: Two letter country code.
+        @return: Integer index into ccodes, or -1 if no city has that country code.
+        """
+        return self._getCountryGroupTable()[2].get(ccode.upper(),-1)
+
+    def getName(self,i):
+        """
+        Return the name of a single city.
+        @param i: Index of city in store.
+        @return: City name string.
+        """
+        return self.namebuf[self.nameoff[i]:self.nameoff[i+1]].tostring()
+
+    def getNames(self,idx=None):
+        """
+        Return a list of city names.
+        @keyword idx: Sequence of city indices (all cities if None).
+        @return: List of city name strings.
+        """
+        if idx is None:
+            idx = range(0,len(self))
+        return [self.getName(i) for i in idx]
+
+    def getCity(self,i):
+        """
+        Return a city dictionary for a single city.
+        @param i: Index of city in store.
+        @return: City dictionary, with keys:
+                 - name   City name
+                 - ccode  Two-letter country code.
+                 - lat    Latitude of city center.
+                 - lon    Longitude of city center.
+                 - iscap  Boolean indicating if city is a capital of a region or country.
+                 - pop    Population of city.
+        """
+        city = {}
+        city['name'] = self.getName(i)
+        city['ccode'] = str(self.ccodes[self.cidx[i]])
+        city['lat'] = float(self.lat[i])
+        city['lon'] = float(self.lon[i])
+        city['iscap'] = bool(self.iscap[i])
+        city['pop'] = int(self.pop[i])
+        return city
+
+    def getCities(self,idx=None):
+        """
+        Return a list of city dictionaries.
+        @keyword idx: Sequence of city indices (all cities if None).
+        @return: List of city dictionaries (see getCity()).
+        """
+        if idx is None:
+            idx = range(0,len(self))
+        return [self.getCity(i) for i in idx]
+
+def readCityFile(cityfile,bounds=None,ccodes=None,minpop=None,fcodes=None,asciionly=True):
+    """
+    Parse a GeoNames cities file into a CityStore, keeping only the cities that pass the given filters.
+
+    The file is read one line at a time, and rejected lines are dropped before any of their
+    fields are converted, so peak memory is set by the number of cities kept rather than by
+    the size of the file.
+    @param cityfile: cities1000.txt file from the GeoNames website.
+    @keyword bounds: Sequence of [lonmin,lonmax,latmin,latmax]; only cities inside are kept.  If lonmin
+                     is greater than lonmax, the box is taken to cross the antimeridian.
+    @keyword ccodes: Sequence of two-letter country codes; only cities in these countries are kept.
+    @keyword minpop: Minimum population of cities to keep.
+    @keyword fcodes: Sequence of GeoNames feature codes (i.e., 'PPLC','PPLA'); only cities with these codes are kept.
+    @keyword asciionly: Boolean indicating whether cities with non-ASCII characters in their name should be skipped.
+    @return: CityStore object.
+    """
+    #     1)geonameid         : integer id of record in geonames database
+    #     2)name              : name of geographical point (utf8) varchar(200)
+    #     3)asciiname         : name of geographical point in plain ascii characters, varchar(200)
+    #     4)alternatenames    : alternatenames, comma separated varchar(4000)
+    #     5)latitude          : latitude in decimal degrees (wgs84)
+    #     6)longitude         : longitude in decimal degrees (wgs84)
+    #     7)feature class     : see http://www.geonames.org/export/codes.html, char(1)
+    #     8)feature code      : see http://www.geonames.org/export/codes.html, varchar(10)
+    #     9)country code      : ISO-3166 2-letter country code, 2 characters
+    #     10)cc2              : alternate country codes, comma separated, ISO-3166 2-letter country code, 60 characters
+    #     11)admin1 code      : fipscode (subject to change to iso
+    #                           code), isocode for the us and ch, see file
+    #                           admin1Codes.txt for display names of this code; varchar(20)
+    #     12)admin2 code      : code for the second administrative
+    #                           division, a county in the US, see file admin2Codes.txt;varchar(80)
+    #     13)admin3 code      : code for third level administrative division, varchar(20)
+    #     14)admin4 code      : code for fourth level administrative division, varchar(20)
+    #     15)population       : integer 
+    #     16)elevation        : in meters, integer
+    #     17)gtopo30          : average elevation of 30'x30' (ca 900mx900m) area in meters, integer
+    #     18)timezone         : the timezone id (see file timeZone.txt)
+    #     19)modification date: date of last modification in yyyy-MM-dd format
+    CAPFLAG1 = 'PPLC'
+    CAPFLAG2 = 'PPLA'
+    names = []
+    cities_ccodes = []
+    lats = array.array('d')
+    lons = array.array('d')
+    iscaps = array.array('b')
+    pops = array.array('l')
+    if ccodes is not None:
+        ccodes = set([ccode.upper() for ccode in ccodes])
+    if fcodes is not None:
+        fcodes = set(fcodes)
+    if bounds is not None:
+        xmin,xmax,ymin,ymax = bounds
+    if not os.path.isfile(cityfile):
+        raise CityStoreError, 'Could not find specified city file %s.' % (cityfile)
+    f = open(cityfile,'rt')
+    for line in f:
+        parts = line.split('\t')
+        ccode = parts[8].strip()
+        if ccodes is not None and ccode.upper() not in ccodes:
+            continue
+        fcode = parts[7].strip()
+        if fcodes is not None and fcode not in fcodes:
+            continue
+        pop = int(parts[14].strip())
+        if minpop is not None and pop < minpop:
+            continue
+        lat = float(parts[4].strip())
+        lon = float(parts[5].strip())
+        if bounds is not None:
+            if lat < ymin or lat > ymax:
+                continue
+            if xmin <= xmax and (lon < xmin or lon > xmax):
+                continue
+            if xmin > xmax and (lon < xmin and lon > xmax):
+                continue
+        name = parts[2].strip()
+        if not name:
+            #print 'Found a city with no name'
+            continue
+        if asciionly:
+            try:
+                name.decode('ascii')
+            except UnicodeDecodeError:
+                continue
+        names.append(name)
+        cities_ccodes.append(ccode)
+        lats.append(lat)
+        lons.append(lon)
+        iscaps.append(fcode == CAPFLAG1 or parts[7] == CAPFLAG2)
+        pops.append(pop)
+    f.close()
+    return CityStore(names,cities_ccodes,lats,lons,pops,iscaps)
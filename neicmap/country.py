@@ -4,6 +4,253 @@ import sys
 import re
 import csv
 import os.path
+import numpy
+from collections import namedtuple
+from neicmap.lru import LRUCache
+
+#compact, immutable record describing one country (see getCountry())
+Country = namedtuple('Country',['name','alpha2','alpha3','number','shortname'])
+
+class CountryTable(object):
+    """
+    Immutable lookup table of country information, indexed by ISO code and by name.
+
+    The table is read from countries.csv once per process (see getCountryTable()).
+    """
+    def __init__(self,countryfile):
+        """
+        Read country information from a CSV file.
+        @param countryfile: Path to CSV file with rows of name,alpha2,alpha3,number[,shortname].
+        """
+        rows = []
+        countries = []
+        self.byAlpha2 = {}
+        self.byAlpha3 = {}
+        self.byNumber = {}
+        self.byName = {}
+        reader = csv.reader(open(countryfile,'rt'))
+        for row in reader:
+            row[3] = int(row[3])
+            rows.append(tuple(row))
+            if len(row) == 5:
+                shortname = row[4]
+            else:
+                shortname = row[0]
+            country = Country(row[0],row[1],row[2],row[3],shortname)
+            countries.append(country)
+            self.byAlpha2.setdefault(country.alpha2.upper(),country)
+            self.byAlpha3.setdefault(country.alpha3.upper(),country)
+            self.byNumber.setdefault(country.number,country)
+            for name in (country.name,country.shortname):
+                self.byName.setdefault(normalizeCountryName(name),country)
+        self.rows = tuple(rows)
+        self.countries = tuple(countries)
+        #dense lookup arrays, indexed by numeric ISO code
+        size = max([country.number for country in countries] + [0]) + 1
+        namelen = max([len(country.name) for country in countries] + [1])
+        self.numberKnown = numpy.zeros(size,dtype=numpy.bool_)
+        self.alpha2Array = numpy.zeros(size,dtype='S2')
+        self.alpha3Array = numpy.zeros(size,dtype='S3')
+        self.nameArray = numpy.zeros(size,dtype='S%i' % namelen)
+        for country in reversed(countries):
+            self.numberKnown[country.number] = True
+            self.alpha2Array[country.number] = country.alpha2
+            self.alpha3Array[country.number] = country.alpha3
+            self.nameArray[country.number] = country.name
+
+    def __len__(self):
+        return len(self.countries)
+
+_countryTable = None
+
+def getCountryTable():
+    """
+    Return the process-wide CountryTable, reading countries.csv the first time it is needed.
+    @return: CountryTable object.
+    """
+    global _countryTable
+    if _countryTable is None:
+        homedir = os.path.dirname(os.path.abspath(__file__)) #where is this script?
+        _countryTable = CountryTable(os.path.join(homedir,'countries.csv'))
+    return _countryTable
+
+def normalizeCountryName(name):
+    """
+    Normalize a country name for lookups: lower case, with surrounding and repeated whitespace removed.
+    @param name: Country name.
+    @return: Normalized country name.
+    """
+    return ' '.join(name.lower().split())
+
+#alternate names, keyed by two letter code, recognized by the fuzzy country name matcher
+COUNTRY_ALIASES = {'US':['USA','United States of America'],
+                   'GB':['UK','Great Britain','Britain','England','Scotland','Wales','Northern Ireland'],
+                   'RU':['Russia'],
+                   'VN':['Vietnam'],
+                   'CI':['Ivory Coast','Cote d\'Ivoire'],
+                   'CW':['Curacao'],
+                   'BL':['Saint Barthelemy'],
+                   'MM':['Myanmar'],
+                   'TL':['East Timor'],
+                   'CZ':['Czechia'],
+                   'CV':['Cabo Verde'],
+                   'SZ':['Eswatini'],
+                   'MK':['North Macedonia'],
+                   'SY':['Syria'],
+                   'TZ':['Tanzania'],
+                   'VE':['Venezuela'],
+                   'MD':['Moldova'],
+                   'FM':['Micronesia'],
+                   'PS':['Palestine'],
+                   'VA':['Vatican'],
+                   'FK':['Falkland Islands'],
+                   'CD':['DRC','Congo-Kinshasa'],
+                   'CG':['Congo-Brazzaville'],
+                   #PAGER US earthquake regions
+                   'XF':['California'],
+                   'WU':['Western United States','Western US'],
+                   'EU':['Central United States','Eastern United States','Central/Eastern United States']}
+
+_nonword = re.compile('[^a-z0-9\x80-\xff]+')
+
+def _normalizeMatchName(name):
+    """
+    Normalize a country name for fuzzy matching: lower case, punctuation replaced by spaces, leading 'the' removed.
+    """
+    name = _nonword.sub(' ',name.lower()).strip()
+    if name.startswith('the '):
+        name = name[4:]
+    return name
+
+def _getTrigrams(name):
+    return set([name[i:i+3] for i in range(0,len(name)-2)])
+
+class CountryNameMatcher(object):
+    """
+    Resolves free-form strings (i.e., 'off the coast of Northern California') to countries.
+
+    Full names, short names and aliases (see COUNTRY_ALIASES) are normalized once and indexed by
+    character trigram.  A query is compared only against names sharing a trigram with it, and
+    candidates are ranked by:
+     1. The name equals the query.
+     2. The name appears in the query as whole words (longer names win, so 'South Sudan' beats 'Sudan').
+     3. The query appears in the name as whole words (shorter names win).
+     4. The name contains, or is contained by, the query as plain text (shorter names win).
+    Remaining ties go to the country listed first in countries.csv.  Results are memoized in a
+    bounded LRU cache.
+    """
+    def __init__(self,table,maxcache=1024):
+        """
+        Build a CountryNameMatcher.
+        @param table: CountryTable object.
+        @keyword maxcache: Maximum number of query results to cache.
+        """
+        self.table = table
+        self.cache = LRUCache(maxcache)
+        #names[i] is a (normalized name,index of country in table) tuple
+        self.names = []
+        self.byTrigram = {}
+        for i in range(0,len(table.countries)):
+            country = table.countries[i]
+            names = [country.name,country.shortname] + COUNTRY_ALIASES.get(country.alpha2,[])
+            for name in set([_normalizeMatchName(name) for name in names]):
+                self.names.append((name,i))
+        self.names.sort(key=lambda x:(x[1],x[0]))
+        for j in range(0,len(self.names)):
+            for trigram in _getTrigrams(self.names[j][0]):
+                self.byTrigram.setdefault(trigram,[]).append(j)
+
+    def getMatches(self,value,exact=False):
+        """
+        Return all countries matching a string, best match first.
+        @param value: String containing (part of) a country name.
+        @keyword exact: If True, only return countries with a name or alias equal to the string.
+        @return: List of Country namedtuples.
+        """
+        query = _normalizeMatchName(value)
+        if not query:
+            return []
+        trigrams = _getTrigrams(query)
+        if trigrams:
+            candidates = set()
+            for trigram in trigrams:
+                candidates.update(self.byTrigram.get(trigram,[]))
+        else:
+            candidates = range(0,len(self.names))
+        paddedquery = ' %s ' % query
+        best = {}
+        for j in candidates:
+            name,i = self.names[j]
+            if name == query:
+                rank = (0,0)
+            elif exact:
+                continue
+            elif ' %s ' % name in paddedquery:
+                rank = (1,-len(name))
+            elif paddedquery in ' %s ' % name:
+                rank = (2,len(name))
+            elif name in query or query in name:
+                rank = (3,len(name))
+            else:
+                continue
+            if i not in best or rank < best[i]:
+                best[i] = rank
+        order = sorted(best.keys(),key=lambda i:(best[i],i))
+        return [self.table.countries[i] for i in order]
+
+    def match(self,value,exact=False):
+        """
+        Return the best country match for a string.
+        @param value: String containing (part of) a country name.
+        @keyword exact: If True, only match countries with a name or alias equal to the string.
+        @return: Country namedtuple, or None if no country matches.
+        """
+        country = self.cache.get((value,exact),self)
+        if country is self:
+            matches = self.getMatches(value,exact=exact)
+            if matches:
+                country = matches[0]
+            else:
+                country = None
+            self.cache.put((value,exact),country)
+        return country
+
+_countryMatcher = None
+
+def getCountryMatcher():
+    """
+    Return the process-wide CountryNameMatcher, building it the first time it is needed.
+    @return: CountryNameMatcher object.
+    """
+    global _countryMatcher
+    if _countryMatcher is None:
+        _countryMatcher = CountryNameMatcher(getCountryTable())
+    return _countryMatcher
+
+def getCountry(value):
+    """
+    Return a Country record from input, using O(1) lookups on ISO codes and exact (normalized) names.
+
+    See getCountryCode() for the kinds of input accepted.  Unlike getCountryCode(), names
+    are only matched exactly (ignoring case and whitespace); no regular expressions are used.
+    @param value: Two or three letter ISO code, numeric ISO code, or country name.
+    @return: Country namedtuple (name,alpha2,alpha3,number,shortname), or None if no country matches.
+    """
+    table = getCountryTable()
+    if type(value) is IntType:
+        return table.byNumber.get(value)
+    if type(value) is not StringType:
+        msg = 'Unsupported country search key %s with type %s' % (str(value),type(value))
+        raise TypeError, msg
+    if len(value) == 2:
+        country = table.byAlpha2.get(value.upper())
+    elif len(value) == 3:
+        country = table.byAlpha3.get(value.upper())
+    else:
+        country = None
+    if country is None:
+        country = table.byName.get(normalizeCountryName(value))
+    return country
 
 def getCountryCode(value):
     """
@@ -21,65 +268,110 @@ def getCountryCode(value):
       - Two letter ISO country code (i.e., 'US' for United States)
       - Three letter ISO country code (i.e., 'USA' for United States)
       - Numeric ISO country code (i.e. 840 for United States)
-      - String (preferably short) containing the name of the country.  Regular expressions will be used to attempt a match.
-        NB:  The first potential match will be returned!
+      - String (preferably short) containing the name of the country.  An exact match (ignoring case) of the full
+        or short name is tried first; failing that, the best match found by CountryNameMatcher is returned.
+        Two and three letter strings that are not ISO codes only match names and aliases exactly (i.e., 'UK').
     @return: Dictionary containing the following values:
       - 'name' Full country name.
       - 'alpha2' Two letter ISO country code.
       - 'alpha3' Three letter ISO country code.
       - 'number' Numeric ISO country code.
+      - 'shortname' Short country name.
     """
-    doRegMatch = False
-    doNumberMatch = False
-    if type(value) is StringType:
-        if len(value) != 2 and len(value) != 3:
-            doRegMatch = True
-    elif type(value) is IntType:
-        doNumberMatch = True
-    else:
+    if type(value) is not StringType and type(value) is not IntType:
         msg = 'Unsupported country search key %s with type %s' % (str(value),type(value))
         raise TypeError, msg
-    clist = getCountryList()
     cdict = {'name':'','alpha2':'','alpha3':'','number':0,'shortname':''}
-    for country in clist:
-        if doRegMatch:
-            s1 = re.search(value.lower(),country[0].lower())
-            s2 = re.search(country[0].lower(),value.lower())
-            if s1 is not None or s2 is not None:
-                cdict['name'] = country[0]
-                cdict['alpha2'] = country[1]
-                cdict['alpha3'] = country[2]
-                cdict['number'] = int(country[3])
-                if len(country) == 5:
-                    cdict['shortname'] = country[4]
-                else:
-                    cdict['shortname'] = country[0]
-                break
-        if doNumberMatch:
-            if value in country:
-                cdict['name'] = country[0]
-                cdict['alpha2'] = country[1]
-                cdict['alpha3'] = country[2]
-                cdict['number'] = int(country[3])
-                if len(country) == 5:
-                    cdict['shortname'] = country[4]
-                else:
-                    cdict['shortname'] = country[0]
-                break
-            else:
-                continue
-        if value in country or value.upper() in country:
-            cdict['name'] = country[0]
-            cdict['alpha2'] = country[1]
-            cdict['alpha3'] = country[2]
-            cdict['number'] = int(country[3])
-            if len(country) == 5:
-                cdict['shortname'] = country[4]
-            else:
-                cdict['shortname'] = country[0]
-            break
+    country = getCountry(value)
+    if country is None and type(value) is StringType:
+        #unknown two and three letter strings may still be aliases (i.e., 'UK'), but are not
+        #matched as parts of longer names
+        exact = len(value) == 2 or len(value) == 3
+        country = getCountryMatcher().match(value,exact=exact)
+    if country is not None:
+        cdict['name'] = country.name
+        cdict['alpha2'] = country.alpha2
+        cdict['alpha3'] = country.alpha3
+        cdict['number'] = country.number
+        cdict['shortname'] = country.shortname
     return cdict
         
+def _numericLookup(codes,lut,unknown):
+    """
+    Look up numeric ISO codes in a dense lookup array from the CountryTable.
+    """
+    table = getCountryTable()
+    codes = numpy.asarray(codes)
+    valid = (codes >= 0) & (codes < len(lut))
+    idx = numpy.where(valid,codes,0).astype(numpy.intp)
+    valid &= table.numberKnown[idx]
+    result = lut[idx]
+    if not valid.all():
+        result = numpy.where(valid,result,unknown)
+    return result
+
+def numericToAlpha2(codes,unknown=''):
+    """
+    Convert an array of numeric ISO country codes to two letter ISO codes.
+    @param codes: Array (any shape) or sequence of integer numeric ISO codes (i.e., 840).
+    @keyword unknown: Value to use for codes that are not in the country table.
+    @return: Numpy string array (same shape as codes) of two letter ISO codes (i.e., 'US').
+    """
+    return _numericLookup(codes,getCountryTable().alpha2Array,unknown)
+
+def numericToAlpha3(codes,unknown=''):
+    """
+    Convert an array of numeric ISO country codes to three letter ISO codes.
+    @param codes: Array (any shape) or sequence of integer numeric ISO codes (i.e., 840).
+    @keyword unknown: Value to use for codes that are not in the country table.
+    @return: Numpy string array (same shape as codes) of three letter ISO codes (i.e., 'USA').
+    """
+    return _numericLookup(codes,getCountryTable().alpha3Array,unknown)
+
+def numericToName(codes,unknown=''):
+    """
+    Convert an array of numeric ISO country codes to country names.
+    @param codes: Array (any shape) or sequence of integer numeric ISO codes (i.e., 840).
+    @keyword unknown: Value to use for codes that are not in the country table.
+    @return: Numpy string array (same shape as codes) of full country names.
+    """
+    return _numericLookup(codes,getCountryTable().nameArray,unknown)
+
+def _alphaLookup(codes,index,unknown):
+    """
+    Convert an array of alpha codes to numeric codes, looking up each distinct code only once.
+    """
+    codes = numpy.asarray(codes)
+    if codes.size == 0:
+        return numpy.zeros(codes.shape,dtype=numpy.int64)
+    ucodes,inverse = numpy.unique(codes,return_inverse=True)
+    unumbers = numpy.zeros(len(ucodes),dtype=numpy.int64)
+    for i in range(0,len(ucodes)):
+        country = index.get(str(ucodes[i]).upper())
+        if country is None:
+            unumbers[i] = unknown
+        else:
+            unumbers[i] = country.number
+    return unumbers[inverse].reshape(codes.shape)
+
+def alpha2ToNumeric(codes,unknown=0):
+    """
+    Convert an array of two letter ISO country codes to numeric ISO codes.
+    @param codes: Array (any shape) or sequence of two letter ISO codes (case insensitive).
+    @keyword unknown: Value to use for codes that are not in the country table.
+    @return: Numpy integer array (same shape as codes) of numeric ISO codes.
+    """
+    return _alphaLookup(codes,getCountryTable().byAlpha2,unknown)
+
+def alpha3ToNumeric(codes,unknown=0):
+    """
+    Convert an array of three letter ISO country codes to numeric ISO codes.
+    @param codes: Array (any shape) or sequence of three letter ISO codes (case insensitive).
+    @keyword unknown: Value to use for codes that are not in the country table.
+    @return: Numpy integer array (same shape as codes) of numeric ISO codes.
+    """
+    return _alphaLookup(codes,getCountryTable().byAlpha3,unknown)
+
 def getCountryList():
     """
     Return list of country information.
@@ -94,14 +386,7 @@ def getCountryList():
       - Numeric ISO code (i.e., '4')
       - (optional) Short country name
     """
-    country = []
-    homedir = os.path.dirname(os.path.abspath(__file__)) #where is this script?
-    countryfile = os.path.join(homedir,'countries.csv')
-    reader = csv.reader(open(countryfile,'rt'))
-    for row in reader:
-        row[3] = int(row[3])
-        country.append(row)
-    return country
+    return [list(row) for row in getCountryTable().rows]
 
 def getLongestCountryName(useshort=False):
     clist = getCountryList()
@@ -2,6 +2,10 @@
 #from numpy import *
 import numpy
 
+#compass point labels, in order of increasing azimuth starting at North
+COMPASS_SHORT = numpy.array(['N','NE','E','SE','S','SW','W','NW'])
+COMPASS_LONG = numpy.array(['North','Northeast','East','Southeast','South','Southwest','West','Northwest'])
+
 def getCompassDir(lat1,lon1,lat2,lon2,format='short'):
     """
     Get the nearest string compass direction between two points.
@@ -11,64 +15,76 @@ def getCompassDir(lat1,lon1,lat2,lon2,format='short'):
     @param lon2: Longitude of second point.
     @keyword format: String used to determine the type of output. ('short','long').
     @return: String compass direction, in the form of 'North','Northeast',... if format is 'long', 
-             or 'N','NE',... if format is 'short'.
+             or 'N','NE',... if format is 'short'.  If any input is an array, a Numpy array of
+             compass directions is returned instead (see getCompassDirs()).
+    """
+    dirs = getCompassDirs(lat1,lon1,lat2,lon2,format=format)
+    if dirs.ndim == 0:
+        return str(dirs)
+    return dirs
+
+def getCompassDirs(lat1,lon1,lat2,lon2,format='short'):
+    """
+    Get the nearest string compass directions between many pairs of points.
+    @param lat1: Latitude(s) of first point(s).
+    @param lon1: Longitude(s) of first point(s).
+    @param lat2: Latitude(s) of second point(s).
+    @param lon2: Longitude(s) of second point(s).
+    @keyword format: String used to determine the type of output. ('short','long').
+    @return: Numpy string array of compass directions (see getCompassDir()), with the broadcast
+             shape of the inputs.
+    """
+    az = getAzimuth(lat1,lon1,lat2,lon2)
+    return getCompassDirFromAzimuth(az,format=format)
+
+def getCompassDirFromAzimuth(az,format='short'):
+    """
+    Get the nearest string compass direction(s) for azimuth(s).
+    @param az: Azimuth(s) in degrees clockwise from North.
+    @keyword format: String used to determine the type of output. ('short','long').
+    @return: Numpy string array of compass directions (see getCompassDir()), same shape as az.
     """
     if format != 'short':
-        points = ['North','Northeast','East','Southeast','South','Southwest','West','Northwest']
+        points = COMPASS_LONG
     else:
-        points = ['N','NE','E','SE','S','SW','W','NW']
-    az = getAzimuth(lat1,lon1,lat2,lon2)
-    angles = numpy.arange(0,360,45)
-    adiff = abs(az - angles)
-    i = adiff.argmin()
+        points = COMPASS_SHORT
+    #each compass point covers the 45 degrees centered on it, so 359 degrees is North
+    i = numpy.floor((numpy.asarray(az) + 22.5)/45.0).astype(numpy.intp) % 8
     return points[i]
 
 def getAzimuth(lat1,lon1,lat2,lon2):
     """
     Get the numerical compass direction between two points.
-    @param lat1: Latitude of first point.
-    @param lon1: Longitude of first point.
-    @param lat2: Latitude of second point.
-    @param lon2: Longitude of second point.
-    @return: Numerical compass direction between two input points.
+    @param lat1: Latitude(s) of first point(s).
+    @param lon1: Longitude(s) of first point(s).
+    @param lat2: Latitude(s) of second point(s).
+    @param lon2: Longitude(s) of second point(s).
+    @return: Numerical compass direction(s) (0-360 degrees) from the first point(s) to the second,
+             with the broadcast shape of the inputs (a scalar if all inputs are scalars).
     """
     DE2RA = 0.01745329252 
     RA2DE = 57.2957795129
-    lat1 = lat1 * DE2RA
-    lat2 = lat2 * DE2RA
-    lon1 = lon1 * DE2RA
-    lon2 = lon2 * DE2RA
+    lat1 = numpy.asarray(lat1) * DE2RA
+    lat2 = numpy.asarray(lat2) * DE2RA
+    lon1 = numpy.asarray(lon1) * DE2RA
+    lon2 = numpy.asarray(lon2) * DE2RA
     
     ilat1 = numpy.floor(0.50 + lat1 * 360000.0)
     ilat2 = numpy.floor(0.50 + lat2 * 360000.0)
     ilon1 = numpy.floor(0.50 + lon1 * 360000.0)
     ilon2 = numpy.floor(0.50 + lon2 * 360000.0)
-    
-    result = 0
-    
-    if ((ilat1 == ilat2) and (ilon1 == ilon2)):
-        return result
-    elif (ilon1 == ilon2):
-         if (ilat1 > ilat2):
-             result = 180.0
-
-    else:
-       c = numpy.arccos(numpy.sin(lat2)*numpy.sin(lat1) + numpy.cos(lat2)*numpy.cos(lat1)*numpy.cos((lon2-lon1)))
-       A = numpy.arcsin(numpy.cos(lat2)*numpy.sin((lon2-lon1))/numpy.sin(c))
-       result = (A * RA2DE)
-
-       if (ilat2 > ilat1) and (ilon2 > ilon1):
-          pass
-       elif ((ilat2 < ilat1) and (ilon2 < ilon1)):
-         result = 180.0 - result
-       elif ((ilat2 < ilat1) and (ilon2 > ilon1)):
-         result = 180.0 - result
-       elif ((ilat2 > ilat1) and (ilon2 < ilon1)):
-         result = result + 360.0
-
-    if result < 0:
-       result = result + 360
 
+    dlon = lon2-lon1
+    y = numpy.sin(dlon)*numpy.cos(lat2)
+    x = numpy.cos(lat1)*numpy.sin(lat2) - numpy.sin(lat1)*numpy.cos(lat2)*numpy.cos(dlon)
+    result = numpy.arctan2(y,x) * RA2DE
+    result = numpy.where(result < 0,result + 360,result)
+    #points on the same meridian are due north or due south of each other
+    result = numpy.where(ilon1 == ilon2,numpy.where(ilat1 > ilat2,180.0,0.0),result)
+    #co-incident points have no direction
+    result = numpy.where((ilat1 == ilat2) & (ilon1 == ilon2),0.0,result)
+    if result.ndim == 0:
+        return float(result)
     return result
 
 def distance(x1, y1, x2, y2):
@@ -79,49 +95,81 @@ def distance(x1, y1, x2, y2):
        Originally from: Vincenty inverse formula - T Vincenty, "Direct and Inverse Solutions of Geodesics on the 
             Ellipsoid with application of nested equations", Survey Review, vol XXII no 176, 1975   
             http://www.ngs.noaa.gov/PUBS_LIB/inverse.pdf                                             
+
+       Inputs may be scalars or arrays, which are broadcast against each other.  All point pairs
+       are iterated together, and each pair stops iterating as soon as it converges.
+       @param x1: Latitude(s) of first point(s).
+       @param y1: Longitude(s) of first point(s).
+       @param x2: Latitude(s) of second point(s).
+       @param y2: Longitude(s) of second point(s).
+       @return: Ellipsoidal (WGS-84) distance(s) in meters, 0 for co-incident points, and -1 where the
+                formula failed to converge (nearly antipodal points).  Scalar if all inputs are scalars.
     """
     #WGS-84 ellipsoid params
     a = 6378137.0
     b = 6356752.314245
     f = 1/298.257223563 
 
-    L = radians(y2-y1);
-    U1 = numpy.arctan((1-f) * numpy.tan(radians(x1)))
-    U2 = numpy.arctan((1-f) * numpy.tan(radians(x2)))
+    x1,y1,x2,y2 = numpy.broadcast_arrays(*[numpy.asarray(v,dtype=numpy.float64) for v in (x1,y1,x2,y2)])
+    shape = x1.shape
+    L = numpy.radians(y2-y1).ravel()
+    U1 = numpy.arctan((1-f) * numpy.tan(numpy.radians(x1.ravel())))
+    U2 = numpy.arctan((1-f) * numpy.tan(numpy.radians(x2.ravel())))
     sinU1 = numpy.sin(U1)
     cosU1 = numpy.cos(U1)
     sinU2 = numpy.sin(U2)
     cosU2 = numpy.cos(U2)
-    cosSqAlpha = sinSigma = cosSigma = cos2SigmaM = sigma = 0.0
-    lmbd = L
-    lambdaP = iterLimit = 100.0
-
-    while abs(lmbd-lambdaP) > 1e-12 and iterLimit > 0:
-        iterLimit -= 1
-        sinLambda = numpy.sin(lmbd)
-        cosLambda = numpy.cos(lmbd);
-        sinSigma = (numpy.sqrt((cosU2*sinLambda) * (cosU2*sinLambda) + 
-            (cosU1*sinU2-sinU1*cosU2*cosLambda) * (cosU1*sinU2-sinU1*cosU2*cosLambda)))
-
-        if sinSigma==0: 
-            return 0   #co-incident points
-        cosSigma = sinU1*sinU2 + cosU1*cosU2*cosLambda
-        sigma = atan2(sinSigma, cosSigma)
-        sinAlpha = cosU1 * cosU2 * sinLambda / sinSigma
-        cosSqAlpha = 1 - sinAlpha*sinAlpha
-        cos2SigmaM = cosSigma - 2*sinU1*sinU2/cosSqAlpha
-        try: #fail equatorial on python <2.6
-            if isnan(cos2SigmaM):
-                cos2SigmaM = 0 # equatorial line: cosSqAlpha=0 (6)
-        except: 
-            pass
-        C = f/16*cosSqAlpha*(4+f*(4-3*cosSqAlpha))
-        lambdaP = lmbd
-        lmbd = (L + (1-C) * f * sinAlpha *
-            (sigma + C*sinSigma*(cos2SigmaM+C*cosSigma*(-1+2*cos2SigmaM*cos2SigmaM))))
-
-    if iterLimit==0:
-        return -1 #formula failed to converge
+    npairs = L.size
+    cosSqAlpha = numpy.zeros(npairs)
+    sinSigma = numpy.zeros(npairs)
+    cosSigma = numpy.zeros(npairs)
+    cos2SigmaM = numpy.zeros(npairs)
+    sigma = numpy.zeros(npairs)
+    lmbd = L.copy()
+    coincident = numpy.zeros(npairs,dtype=numpy.bool_)
+    failed = numpy.zeros(npairs,dtype=numpy.bool_)
+
+    #indices of the point pairs that have not converged yet
+    active = numpy.arange(npairs)
+    iterLimit = 100
+    #co-incident and equatorial pairs divide by zero; they are dealt with below
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        while len(active) and iterLimit > 0:
+            iterLimit -= 1
+            sU1 = sinU1[active]
+            cU1 = cosU1[active]
+            sU2 = sinU2[active]
+            cU2 = cosU2[active]
+            lambdaP = lmbd[active]
+            sinLambda = numpy.sin(lambdaP)
+            cosLambda = numpy.cos(lambdaP)
+            sS = (numpy.sqrt((cU2*sinLambda) * (cU2*sinLambda) + 
+                (cU1*sU2-sU1*cU2*cosLambda) * (cU1*sU2-sU1*cU2*cosLambda)))
+            cS = sU1*sU2 + cU1*cU2*cosLambda
+            sg = numpy.arctan2(sS, cS)
+            sinAlpha = cU1 * cU2 * sinLambda / sS
+            cSqA = 1 - sinAlpha*sinAlpha
+            c2SM = cS - 2*sU1*sU2/cSqA
+            c2SM[cSqA == 0] = 0 # equatorial line: cosSqAlpha=0 (6)
+            C = f/16*cSqA*(4+f*(4-3*cSqA))
+            lmbdNew = (L[active] + (1-C) * f * sinAlpha *
+                (sg + C*sS*(c2SM+C*cS*(-1+2*c2SM*c2SM))))
+
+            sinSigma[active] = sS
+            cosSigma[active] = cS
+            sigma[active] = sg
+            cosSqAlpha[active] = cSqA
+            cos2SigmaM[active] = c2SM
+            lmbd[active] = lmbdNew
+
+            isCoincident = sS == 0
+            coincident[active[isCoincident]] = True
+            isFailed = ~numpy.isfinite(lmbdNew) & ~isCoincident
+            failed[active[isFailed]] = True
+            done = isCoincident | isFailed | (numpy.abs(lmbdNew-lambdaP) <= 1e-12)
+            active = active[~done]
+
+    failed[active] = True #formula failed to converge
 
     uSq = cosSqAlpha * (a*a - b*b) / (b*b)
     A = 1 + uSq/16384*(4096+uSq*(-768+uSq*(320-175*uSq)))
@@ -129,7 +177,11 @@ def distance(x1, y1, x2, y2):
     deltaSigma = B*sinSigma*(cos2SigmaM+B/4*(cosSigma*(-1+2*cos2SigmaM*cos2SigmaM)-
             B/6*cos2SigmaM*(-3+4*sinSigma*sinSigma)*(-3+4*cos2SigmaM*cos2SigmaM)))
     s = b*A*(sigma-deltaSigma)
-    return s
+    s[coincident] = 0
+    s[failed] = -1
+    if len(shape) == 0:
+        return s[0]
+    return s.reshape(shape)
     
 def sdist(lat1,lon1,lat2,lon2):
     """
@@ -151,6 +203,197 @@ def sdist(lat1,lon1,lat2,lon2):
     gcdist = R*dsig;
     return gcdist
 
+#default cap (bytes) on the temporary arrays used by getDistanceMatrix() and getDistancePairs()
+DISTANCE_MAXBYTES = 64*1024*1024
+#approximate number of full-size float64 temporaries created by each distance method
+DISTANCE_TEMPS = {'sdist':12,'vincenty':40}
+
+def _getDistanceChunks(lat1,lon1,lat2,lon2,method,maxbytes):
+    """
+    Generate blocks of rows of a distance matrix, sized so the temporaries fit in maxbytes.
+    @return: Generator of (start,stop,block), where block holds the distances (meters) from
+             points start:stop of the first set to all points of the second set.
+    """
+    if method not in DISTANCE_TEMPS:
+        raise ValueError, 'Unsupported distance method "%s"' % method
+    lat1 = numpy.atleast_1d(numpy.asarray(lat1,dtype=numpy.float64))
+    lon1 = numpy.atleast_1d(numpy.asarray(lon1,dtype=numpy.float64))
+    lat2 = numpy.atleast_1d(numpy.asarray(lat2,dtype=numpy.float64))
+    lon2 = numpy.atleast_1d(numpy.asarray(lon2,dtype=numpy.float64))
+    nrows = len(lat1)
+    ncols = max(len(lat2),1)
+    chunksize = max(1,int(maxbytes // (ncols*8*DISTANCE_TEMPS[method])))
+    for start in range(0,nrows,chunksize):
+        stop = min(start+chunksize,nrows)
+        rlat = lat1[start:stop,numpy.newaxis]
+        rlon = lon1[start:stop,numpy.newaxis]
+        if method == 'sdist':
+            block = sdist(rlat,rlon,lat2,lon2)
+        else:
+            block = distance(rlat,rlon,lat2,lon2)
+        yield (start,stop,block)
+
+def getDistanceMatrix(lat1,lon1,lat2,lon2,method='sdist',maxbytes=DISTANCE_MAXBYTES,out=None):
+    """
+    Compute the distance from every point in one set to every point in another.
+
+    The matrix is computed a block of rows at a time, so that the temporary arrays never take
+    more than (roughly) maxbytes of memory.  For very large matrices, pass a numpy.memmap as out.
+    @param lat1: Array of M latitudes of first set of points.
+    @param lon1: Array of M longitudes of first set of points.
+    @param lat2: Array of N latitudes of second set of points.
+    @param lon2: Array of N longitudes of second set of points.
+    @keyword method: 'sdist' for great circle distance (see sdist()), or 'vincenty' for
+                     ellipsoidal distance (see distance()).
+    @keyword maxbytes: Approximate memory cap (bytes) on temporary arrays.
+    @keyword out: Optional MxN array (or numpy.memmap) in which to store the results.
+    @return: MxN array of distances in meters (out, if provided).
+    """
+    nrows = len(numpy.atleast_1d(lat1))
+    ncols = len(numpy.atleast_1d(lat2))
+    if out is None:
+        out = numpy.empty((nrows,ncols))
+    elif out.shape != (nrows,ncols):
+        raise ValueError, 'Output array has shape %s, expected %s' % (str(out.shape),str((nrows,ncols)))
+    for start,stop,block in _getDistanceChunks(lat1,lon1,lat2,lon2,method,maxbytes):
+        out[start:stop,:] = block
+    return out
+
+def getDistancePairs(lat1,lon1,lat2,lon2,maxdist,method='sdist',maxbytes=DISTANCE_MAXBYTES):
+    """
+    Find all pairs of points (one from each set) within a given distance of each other.
+
+    This is the sparse equivalent of getDistanceMatrix(); the full matrix is never held in memory.
+    @param lat1: Array of M latitudes of first set of points.
+    @param lon1: Array of M longitudes of first set of points.
+    @param lat2: Array of N latitudes of second set of points.
+    @param lon2: Array of N longitudes of second set of points.
+    @param maxdist: Maximum distance (meters) between pairs of points.
+    @keyword method: 'sdist' or 'vincenty' (see getDistanceMatrix()).
+    @keyword maxbytes: Approximate memory cap (bytes) on temporary arrays.
+    @return: Tuple of (i,j,d) arrays, where d[k] is the distance (meters) between point i[k] of
+             the first set and point j[k] of the second set, ordered by i and then j.
+    """
+    ilist = []
+    jlist = []
+    dlist = []
+    for start,stop,block in _getDistanceChunks(lat1,lon1,lat2,lon2,method,maxbytes):
+        if method == 'vincenty':
+            i,j = (((block >= 0) & (block <= maxdist))).nonzero()
+        else:
+            i,j = (block <= maxdist).nonzero()
+        ilist.append(i + start)
+        jlist.append(j)
+        dlist.append(block[i,j])
+    if not ilist:
+        return (numpy.zeros(0,dtype=numpy.intp),numpy.zeros(0,dtype=numpy.intp),numpy.zeros(0))
+    return (numpy.concatenate(ilist),numpy.concatenate(jlist),numpy.concatenate(dlist))
+
+class DistanceContext(object):
+    """
+    Great circle distances and azimuths from any origin to a fixed set of target points.
+
+    The sines and cosines of the target latitudes and longitudes are computed once, when the
+    context is created, so each query from a new origin is a handful of in-place array operations.
+    Results are identical (to rounding) to sdist() and getAzimuth().  The context keeps its own
+    work arrays, so a single context should not be shared between threads.
+    """
+    def __init__(self,lat,lon):
+        """
+        Create a DistanceContext.
+        @param lat: Array of target latitudes.
+        @param lon: Array of target longitudes (same shape as lat).
+        """
+        lat = numpy.asarray(lat,dtype=numpy.float64)
+        lon = numpy.asarray(lon,dtype=numpy.float64)
+        self.shape = lat.shape
+        self.coslat = cosd(lat)
+        self.sinlat = sind(lat)
+        self.coslon = cosd(lon)
+        self.sinlon = sind(lon)
+        self._work = [numpy.empty(self.shape) for i in range(0,4)]
+
+    def _getTerms(self,lat,lon):
+        """
+        Fill the work arrays with the terms shared by the distance and azimuth formulas.
+        @param lat: Latitude of origin.
+        @param lon: Longitude of origin.
+        @return: Tuple of work arrays (A,B,C,T), where A is cos(lat2)*sin(dlon), B is the
+                 north component of the direction to each target, C is the cosine of the angular
+                 distance to each target, and T is scratch space.
+        """
+        A,B,C,T = self._work
+        coslat1 = cosd(lat)
+        sinlat1 = sind(lat)
+        coslon1 = cosd(lon)
+        sinlon1 = sind(lon)
+        #sin and cos of (lon1 - lon2), from the cached target values
+        numpy.multiply(self.coslon,sinlon1,out=A)
+        numpy.multiply(self.sinlon,coslon1,out=T)
+        numpy.subtract(A,T,out=A)
+        numpy.multiply(self.coslon,coslon1,out=B)
+        numpy.multiply(self.sinlon,sinlon1,out=T)
+        numpy.add(B,T,out=B)
+        numpy.multiply(A,self.coslat,out=A)
+        numpy.multiply(B,self.coslat,out=B)
+        numpy.multiply(self.sinlat,sinlat1,out=C)
+        numpy.multiply(B,coslat1,out=T)
+        numpy.add(C,T,out=C)
+        numpy.multiply(self.sinlat,coslat1,out=T)
+        numpy.multiply(B,sinlat1,out=B)
+        numpy.subtract(T,B,out=B)
+        return (A,B,C,T)
+
+    def getDistance(self,lat,lon,out=None):
+        """
+        Great circle distance (meters) from an origin to each target, as sdist() computes it.
+        @param lat: Latitude of origin.
+        @param lon: Longitude of origin.
+        @keyword out: Optional array (same shape as targets) in which to store the results.
+        @return: Array of distances in meters (out, if provided).
+        """
+        R = 6367*1e3 #radius of the earth in meters, assuming spheroid
+        if out is None:
+            out = numpy.empty(self.shape)
+        A,B,C,T = self._getTerms(lat,lon)
+        numpy.hypot(A,B,out=T)
+        numpy.arctan2(T,C,out=out)
+        numpy.multiply(out,R,out=out)
+        return out
+
+    def getAzimuth(self,lat,lon,out=None):
+        """
+        Numerical compass direction (0-360 degrees) from an origin to each target.
+        @param lat: Latitude of origin.
+        @param lon: Longitude of origin.
+        @keyword out: Optional array (same shape as targets) in which to store the results.
+        @return: Array of azimuths in degrees (out, if provided).
+        """
+        if out is None:
+            out = numpy.empty(self.shape)
+        A,B,C,T = self._getTerms(lat,lon)
+        numpy.negative(A,out=A)
+        numpy.arctan2(A,B,out=out)
+        numpy.degrees(out,out=out)
+        numpy.mod(out,360.0,out=out)
+        out[out >= 360.0] = 0.0
+        return out
+
+    def getRadiusMask(self,lat,lon,radius,out=None):
+        """
+        Find which targets are within a great circle distance of an origin.
+        @param lat: Latitude of origin.
+        @param lon: Longitude of origin.
+        @param radius: Search radius in meters.
+        @keyword out: Optional boolean array (same shape as targets) in which to store the results.
+        @return: Boolean array, True where targets are within radius (out, if provided).
+        """
+        if out is None:
+            out = numpy.empty(self.shape,dtype=numpy.bool_)
+        dist = self.getDistance(lat,lon,out=self._work[2])
+        numpy.less_equal(dist,radius,out=out)
+        return out
+
 def edist(lat1,lon1,lat2,lon2):
     """
     Euclidean distance (meters) between two (or more) latitude/longitude points.
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+import numpy
+
+class GridSampler(object):
+    """
+    Samples grids (i.e., ShakeMap MMI grids) at a fixed set of points.
+
+    The grid row/column of every point is computed once, from the grid's geodict, so sampling
+    any number of grids that share that geometry is a single array indexing operation.
+    """
+    def __init__(self,geodict,lat,lon,method='nearest'):
+        """
+        Compute grid indices for a set of points.
+        @param geodict: Dictionary describing the grid (as used by neicio grids), with at least
+                        the keys xmin, xmax, ymax, xdim, ydim, nrows and ncols.
+        @param lat: Array of point latitudes.
+        @param lon: Array of point longitudes.
+        @keyword method: 'nearest' for nearest neighbor sampling (as Grid.getValue()), or
+                         'linear' for bilinear interpolation.
+        """
+        if method not in ('nearest','linear'):
+            raise ValueError, 'Unsupported sampling method "%s"' % method
+        self.geodict = geodict.copy()
+        self.method = method
+        lat = numpy.asarray(lat,dtype=numpy.float64)
+        lon = numpy.asarray(lon,dtype=numpy.float64)
+        self.npoints = len(lat)
+        xmin = geodict['xmin']
+        nrows = geodict['nrows']
+        ncols = geodict['ncols']
+        #grid crosses the meridian, so points west of xmin are really east of it
+        if geodict['xmax'] < xmin:
+            lon = numpy.where(lon < xmin,lon + 360,lon)
+        row = (geodict['ymax'] - lat)/geodict['ydim']
+        col = (lon - xmin)/geodict['xdim']
+        if method == 'nearest':
+            row = numpy.floor(row + 0.5)
+            col = numpy.floor(col + 0.5)
+        self.inside = (row >= 0) & (row <= nrows-1) & (col >= 0) & (col <= ncols-1)
+        #indices of points inside the grid
+        self.points = numpy.flatnonzero(self.inside)
+        row = row[self.points]
+        col = col[self.points]
+        if method == 'nearest':
+            self.rows = row.astype(numpy.intp)
+            self.cols = col.astype(numpy.intp)
+        else:
+            #points on the last row or column use the cell before it, with full weight on its far side
+            self.rows = numpy.minimum(numpy.floor(row),max(nrows-2,0)).astype(numpy.intp)
+            self.cols = numpy.minimum(numpy.floor(col),max(ncols-2,0)).astype(numpy.intp)
+            self.rowweights = row - self.rows
+            self.colweights = col - self.cols
+
+    def hasGeometry(self,geodict):
+        """
+        Check whether a grid has the geometry this sampler was built for.
+        @param geodict: Grid geodict.
+        @return: True if the grid origin, spacing and shape match.
+        """
+        for key in ('xmin','xmax','ymax','xdim','ydim','nrows','ncols'):
+            if geodict[key] != self.geodict[key]:
+                return False
+        return True
+
+    def sampleInside(self,griddata,dtype=numpy.float64):
+        """
+        Sample a grid at the points that lie inside it.
+        @param griddata: 2D array of grid values.
+        @keyword dtype: Data type of returned array.
+        @return: Array of values, one per point in self.points.
+        """
+        if self.method == 'nearest':
+            return griddata[self.rows,self.cols].astype(dtype)
+        r0 = self.rows
+        c0 = self.cols
+        r1 = numpy.minimum(r0+1,griddata.shape[0]-1)
+        c1 = numpy.minimum(c0+1,griddata.shape[1]-1)
+        wr = self.rowweights
+        wc = self.colweights
+        top = griddata[r0,c0]*(1-wc) + griddata[r0,c1]*wc
+        bottom = griddata[r1,c0]*(1-wc) + griddata[r1,c1]*wc
+        return (top*(1-wr) + bottom*wr).astype(dtype)
+
+    def sample(self,griddata,dtype=numpy.float64,out=None):
+        """
+        Sample a grid at all points.
+        @param griddata: 2D array of grid values.
+        @keyword dtype: Data type of returned array.
+        @keyword out: Optional array (one element per point) in which to store the results.
+        @return: Array of values, one per point, NaN for points outside the grid (out, if provided).
+        """
+        if out is None:
+            out = numpy.empty(self.npoints,dtype=dtype)
+        out.fill(numpy.nan)
+        out[self.points] = self.sampleInside(griddata,dtype=dtype)
+        return out
+
+class ExposureSession(object):
+    """
+    Keeps the city exposure state for one event, so that new ShakeMap versions can be processed incrementally.
+
+    The cities inside the ShakeMap and their grid indices are computed once (and again only if
+    a new version changes the grid geometry), so each new version only resamples the grid.  The
+    PAGER city table is fully recomputed only when the cities with the highest MMI change;
+    otherwise the table cities from the previous version are re-ranked with their new MMI values.
+    """
+    #number of highest-MMI cities that determine the PAGER city table (see PagerCity.getCityTable())
+    NMAX = 6
+
+    def __init__(self,eventid,pagercity,method='nearest'):
+        """
+        Create an ExposureSession.
+        @param eventid: Event ID string.
+        @param pagercity: PagerCity object with cities loaded by loadCities().
+        @keyword method: Grid sampling method, 'nearest' or 'linear' (see GridSampler).
+        """
+        self.eventid = eventid
+        self.pagercity = pagercity
+        self.method = method
+        self.sampler = None
+        self.mmi = None
+        self.table = None
+        self._cities = None
+        self._topkey = None
+        self._tableidx = None
+
+    @property
+    def points(self):
+        """Indices (into the city store) of the cities inside the current ShakeMap."""
+        return self.sampler.points
+
+    def _getExposed(self,idx):
+        """
+        Return copies of candidate city dictionaries, with the current MMI added.
+        """
+        cities = []
+        for i in idx:
+            city = self._cities[i].copy()
+            city['mmi'] = self.mmi[i]
+            cities.append(city)
+        return cities
+
+    def update(self,shakegrid):
+        """
+        Process a (new version of a) ShakeMap for this event.
+        @param shakegrid: ShakeGrid object.
+        @return: PAGER city table (see PagerCity.getCityTable()).
+        """
+        store = self.pagercity.store
+        if self.sampler is None or not self.sampler.hasGeometry(shakegrid.geodict):
+            self.sampler = GridSampler(shakegrid.geodict,store.lat,store.lon,method=self.method)
+            self._cities = store.getCities(self.sampler.points)
+            self._topkey = None
+        self.mmi = self.sampler.sampleInside(shakegrid.griddata)
+        #stable descending order, as used by PagerCity.sortCities()
+        topkey = tuple(numpy.argsort(-self.mmi,kind='mergesort')[0:self.NMAX])
+        if topkey != self._topkey:
+            candidates = self._getExposed(range(0,len(self._cities)))
+            self._tableidx = {}
+            for i in range(0,len(candidates)):
+                self._tableidx[id(candidates[i])] = i
+            table = self.pagercity.getCityTable(candidates)
+            self._tableidx = [self._tableidx[id(city)] for city in table]
+            self._topkey = topkey
+        else:
+            table = self.pagercity.getCityTable(self._getExposed(self._tableidx))
+        self.table = table
+        return table
+
+    def getExposedCities(self):
+        """
+        Return the cities inside the current ShakeMap.
+        @return: List of city dictionaries with MMI added (see PagerCity.getCityExposure()).
+        """
+        return self._getExposed(range(0,len(self._cities)))
+
+def getExposureMatrix(shakegrids,lat,lon,method='nearest',dtype=numpy.float32):
+    """
+    Sample a set of alternative ShakeMap realizations (i.e., a scenario ensemble) at a set of points.
+
+    Points are selected by the first grid, and grid indices are computed once per distinct grid
+    geometry (see GridSampler), so realizations sharing a geometry cost one indexing operation each.
+    @param shakegrids: Sequence of ShakeGrid objects (or any objects with geodict and griddata attributes).
+    @param lat: Array of point latitudes.
+    @param lon: Array of point longitudes.
+    @keyword method: Grid sampling method, 'nearest' or 'linear' (see GridSampler).
+    @keyword dtype: Data type of returned matrix.
+    @return: Tuple of (points,mmi), where points is an integer array of indices of the points inside
+             the first grid, and mmi is a (len(points) x len(shakegrids)) array of sampled values,
+             NaN where a point lies outside a realization whose geometry differs from the first.
+    """
+    if not len(shakegrids):
+        raise ValueError, 'At least one grid is required'
+    lat = numpy.asarray(lat,dtype=numpy.float64)
+    lon = numpy.asarray(lon,dtype=numpy.float64)
+    first = GridSampler(shakegrids[0].geodict,lat,lon,method=method)
+    points = first.points
+    #one column per realization, each stored contiguously
+    mmi = numpy.empty((len(points),len(shakegrids)),dtype=dtype,order='F')
+    samplers = []
+    for j in range(0,len(shakegrids)):
+        shakegrid = shakegrids[j]
+        if first.hasGeometry(shakegrid.geodict):
+            mmi[:,j] = first.sampleInside(shakegrid.griddata,dtype=dtype)
+            continue
+        for sampler in samplers:
+            if sampler.hasGeometry(shakegrid.geodict):
+                break
+        else:
+            sampler = GridSampler(shakegrid.geodict,lat[points],lon[points],method=method)
+            samplers.append(sampler)
+        sampler.sample(shakegrid.griddata,dtype=dtype,out=mmi[:,j])
+    return (points,mmi)
+
+def getExposurePercentiles(mmi,percentiles=(5,50,95)):
+    """
+    Summarize an ensemble exposure matrix (see getExposureMatrix()) by per-point percentiles.
+    @param mmi: (npoints x nrealizations) array of MMI values; NaN values are ignored.
+    @keyword percentiles: Sequence of percentiles (0-100) to compute.
+    @return: (npoints x len(percentiles)) float32 array of MMI percentiles.
+    """
+    mmi = numpy.asarray(mmi)
+    if numpy.isnan(mmi).any():
+        summary = numpy.nanpercentile(mmi,percentiles,axis=1)
+    else:
+        summary = numpy.percentile(mmi,percentiles,axis=1)
+    return summary.T.astype(numpy.float32)
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    Bounded mapping that discards the least recently used entry when it is full.
+    """
+    def __init__(self,maxsize=1024):
+        """
+        Create an empty LRUCache.
+        @keyword maxsize: Maximum number of entries to keep.
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self,key):
+        return key in self._data
+
+    def get(self,key,default=None):
+        """
+        Return the value for key, marking it as most recently used.
+        @param key: Cache key.
+        @keyword default: Value returned when key is not in the cache.
+        @return: Cached value, or default.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def put(self,key,value):
+        """
+        Store a value, discarding the least recently used entry if the cache is full.
+        @param key: Cache key.
+        @param value: Value to store.
+        """
+        self._data.pop(key,None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries."""
+        self._data.clear()
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+import re
+import numpy
+from neicmap.lru import LRUCache
+
+_nonword = re.compile('[^a-z0-9\x80-\xff]+')
+
+def normalizeCityName(name):
+    """
+    Normalize a city name for matching: lower case, with punctuation and runs of whitespace replaced by single spaces.
+    @param name: City name string.
+    @return: Normalized name string.
+    """
+    return _nonword.sub(' ',name.lower()).strip()
+
+class CityNameIndex(object):
+    """
+    Index over a fixed list of city names, for resolving (parts of) names to cities.
+
+    A city matches a query when its normalized name (see normalizeCityName()) contains the
+    normalized query, or is contained in it (i.e., 'Padang' matches '10 km NE of Padang,
+    Indonesia').  Names contained in the query are found by looking up every substring of the
+    query in a hash of the normalized names; names containing the query are found by checking
+    only the names that share the query's least common character trigram.  Matches are ranked by:
+     1. The name equals the query.
+     2. The name appears in the query as whole words (longer names win, so 'Padang Panjang'
+        beats 'Padang').
+     3. The query appears in the name as whole words (shorter names win).
+     4. The name contains, or is contained by, the query as plain text (shorter names win).
+    Remaining ties go to the most populous city, then to the city listed first.  Results are
+    memoized in a bounded LRU cache.
+    """
+    def __init__(self,names,pop,maxcache=1024):
+        """
+        Build a CityNameIndex.
+        @param names: Sequence of city names.
+        @param pop: Sequence of city populations (used to rank matches).
+        @keyword maxcache: Maximum number of query results to cache.
+        """
+        self.pop = numpy.asarray(pop)
+        self.cache = LRUCache(maxcache)
+        self.names = [normalizeCityName(name) for name in names]
+        self.maxlen = 0
+        self.byName = {}
+        self.byTrigram = {}
+        for i in range(0,len(self.names)):
+            name = self.names[i]
+            if not name:
+                continue
+            self.byName.setdefault(name,[]).append(i)
+            self.maxlen = max(self.maxlen,len(name))
+            for trigram in set([name[j:j+3] for j in range(0,len(name)-2)]):
+                self.byTrigram.setdefault(trigram,[]).append(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    def getExactMatches(self,name):
+        """
+        Return the cities whose normalized name equals that of a query.
+        @param name: City name string.
+        @return: Integer array of city indices, most populous first.
+        """
+        idx = numpy.array(sorted(self.byName.get(normalizeCityName(name),[])),dtype=numpy.intp)
+        return idx[numpy.argsort(-self.pop[idx],kind='mergesort')]
+
+    def getMatches(self,name):
+        """
+        Return the cities whose name contains, or is contained in, a query.
+        @param name: String containing (part of) a city name.
+        @return: Integer array of city indices, best match first (see CityNameIndex).
+        """
+        query = normalizeCityName(name)
+        matches = self.cache.get(query)
+        if matches is None:
+            matches = self._rank(query,self._getCandidates(query))
+            self.cache.put(query,matches)
+        return matches.copy()
+
+    def _getCandidates(self,query):
+        """
+        Return the set of indices of cities matching a normalized query.
+        """
+        candidates = set()
+        if not query:
+            return candidates
+        #names contained in the query
+        nquery = len(query)
+        for start in range(0,nquery):
+            for end in range(start+1,min(nquery,start+self.maxlen)+1):
+                candidates.update(self.byName.get(query[start:end],[]))
+        #names containing the query
+        if nquery < 3:
+            for i in range(0,len(self.names)):
+                if query in self.names[i]:
+                    candidates.add(i)
+            return candidates
+        postings = None
+        for j in range(0,nquery-2):
+            tpostings = self.byTrigram.get(query[j:j+3])
+            if tpostings is None:
+                return candidates
+            if postings is None or len(tpostings) < len(postings):
+                postings = tpostings
+        for i in postings:
+            if query in self.names[i]:
+                candidates.add(i)
+        return candidates
+
+    def _rank(self,query,idx):
+        """
+        Sort the indices of cities matching a normalized query, best match first (see CityNameIndex).
+        """
+        paddedquery = ' %s ' % query
+        ranks = []
+        for i in idx:
+            name = self.names[i]
+            if name == query:
+                rank = (0,0)
+            elif ' %s ' % name in paddedquery:
+                rank = (1,-len(name))
+            elif paddedquery in ' %s ' % name:
+                rank = (2,len(name))
+            else:
+                rank = (3,len(name))
+            ranks.append((rank,-self.pop[i],i))
+        ranks.sort()
+        return numpy.array([rank[2] for rank in ranks],dtype=numpy.intp)
@@ -7,8 +7,11 @@ from pylab import *
 class PagerPolygon(object):
     """
     Class to encapsulate polygon objects which we wish to query about points they contain.
+
+    The vertices of all parts are stored once, in a single (N,2) array, and the matplotlib Path
+    and bounding box of each part are built when the polygon is constructed, so that queries
+    only need to run the containment tests.
     """
-    verts = []
     isComplex = False
     nparts = 0
     xmin = None
@@ -16,86 +19,79 @@ class PagerPolygon(object):
     ymin = None
     ymax = None
     bounds = None
+    xy = None
+    partoff = None
+    partbounds = None
+    paths = None
     def __init__(self,inxp,inyp):
         """
         Construct a PagerPolygon object.
         @param xp: Numpy array of x vertices, with parts separated by NaN.
         @param yp: Numpy array of y vertices, with parts separated by NaN.
         """
-        xp = np.array(inxp)
-        yp = np.array(inyp)
-        
-        self.verts = []
-        self.xmin = xp[xp.argmin()]
-        self.xmax = xp[xp.argmax()]
-        self.ymin = yp[yp.argmin()]
-        self.ymax = yp[yp.argmax()]
+        xp = np.array(inxp,dtype=np.float64)
+        yp = np.array(inyp,dtype=np.float64)
+
+        inan = np.flatnonzero(isnan(xp))
+        self.isComplex = len(inan) > 0
+        #vertices of part i are xy[partoff[i]:partoff[i+1]]
+        pstarts = np.concatenate(([0],inan+1))
+        pstops = np.concatenate((inan,[len(xp)]))
+        keep = pstops > pstarts
+        pstarts = pstarts[keep]
+        pstops = pstops[keep]
+        self.nparts = len(pstarts)
+        valid = ~isnan(xp)
+        self.xy = np.column_stack((xp[valid],yp[valid]))
+        self.partoff = np.zeros(self.nparts+1,dtype=np.intp)
+        self.partoff[1:] = np.cumsum(pstops-pstarts)
+        self.partbounds = np.zeros((self.nparts,4))
+        self.paths = []
+        for i in range(0,self.nparts):
+            pxy = self.xy[self.partoff[i]:self.partoff[i+1]]
+            self.partbounds[i] = (pxy[:,0].min(),pxy[:,0].max(),pxy[:,1].min(),pxy[:,1].max())
+            self.paths.append(path.Path(pxy))
+        self.xmin = self.partbounds[:,0].min()
+        self.xmax = self.partbounds[:,1].max()
+        self.ymin = self.partbounds[:,2].min()
+        self.ymax = self.partbounds[:,3].max()
         self.bounds = (self.xmin,self.xmax,self.ymin,self.ymax)
-        if len(find(isnan(xp))):
-            self.isComplex = True
-            #if we have NaN values, then the bounds will be NaN
-            #search through each segment to find valid bounds
-            self.xmin = 99999999
-            self.xmax = -99999999
-            self.ymin = 99999999
-            self.ymax = -99999999
-            inan = find(isnan(xp))
-            self.nparts = len(inan)+1
-            pstart = 0
-            for i in range(0,len(inan)+1):
-                if i == len(inan):
-                    pnan = len(xp)
-                else:
-                    pnan = inan[i]
-
-                #check the ranges of this segment against bounding box
-                if xp[pstart:pnan].min() < self.xmin:
-                    self.xmin = xp[pstart:pnan].min()
-                if xp[pstart:pnan].max() > self.xmax:
-                    self.xmax = xp[pstart:pnan].max()
-                if yp[pstart:pnan].min() < self.ymin:
-                    self.ymin = yp[pstart:pnan].min()
-                if yp[pstart:pnan].max() > self.ymax:
-                    self.ymax = yp[pstart:pnan].max()
-                    
-                self.verts.append(zip(xp[pstart:pnan],yp[pstart:pnan]))
-                pstart = pnan+1
-        else:
-            self.nparts = 1
-            self.verts = zip(xp,yp)
+
+    @property
+    def verts(self):
+        """
+        Polygon vertices as a list of (x,y) tuples, or for complex polygons a list of such lists (one per part).
+        """
+        parts = []
+        for i in range(0,self.nparts):
+            pxy = self.xy[self.partoff[i]:self.partoff[i+1]]
+            parts.append(zip(pxy[:,0],pxy[:,1]))
+        if self.isComplex:
+            return parts
+        return parts[0]
         
-    def containsPoint(self,x,y):
+    def containsPoint(self,x,y,evenodd=False):
         """
         Check to see if PagerPolygon contains input point.
         @param x: X coordinate of point.
         @param y: Y coordinate of point.
+        @keyword evenodd: If True, treat parts lying within other parts as holes (see containsPoints()).
         @return: True if point is inside of polygon, False if outside.
         """
         #do a quick check with the bounding box
         if not (x > self.xmin and x < self.xmax and y > self.ymin and y < self.ymax):
             return False
 
-        if not self.isComplex:
-            xvert,yvert = zip(*self.verts)
-            points = np.ones((len(yvert),2))
-            points[:,0] = xvert
-            points[:,1] = yvert
-            p = path.Path(points)
-            if p.contains_point((x,y)):
-                return True
-            else:
-                return False
-        else:
-            for i in range(0,self.nparts):
-                vertp = self.verts[i]
-                xvert,yvert = zip(*vertp)
-                points = np.ones((len(yvert),2))
-                points[:,0] = xvert
-                points[:,1] = yvert
-                p = path.Path(points)
-                if p.contains_point((x,y)):
+        inside = False
+        for i in range(0,self.nparts):
+            pxmin,pxmax,pymin,pymax = self.partbounds[i]
+            if x < pxmin or x > pxmax or y < pymin or y > pymax:
+                continue
+            if self.paths[i].contains_point((x,y)):
+                if not evenodd:
                     return True
-            return False
+                inside = not inside
+        return inside
 
     def boundingBoxContainsPoint(self,x,y):
         #do a quick check with the bounding box
@@ -103,33 +99,41 @@ class PagerPolygon(object):
             return False
         return True
 
-    def containsPoints(self,x,y):
+    def containsPoints(self,x,y,evenodd=False):
         """
         Check to see which input points are contained by a PagerPolygon.
-        @param x: X coordinates of points.
-        @param y: Y coordinates of points.
-        @return: Numpy array of same length as X and Y, True where inside, False where outside.
-        """
-        if not self.isComplex:
-            points = zip(x,y)
-            xvert,yvert = zip(*self.verts)
-            verts = np.ones((len(yvert),2))
-            verts[:,0] = xvert
-            verts[:,1] = yvert
-            poly = path.Path(verts)
-            return poly.contains_points(points)
-        else:
-            psum = zeros(x.shape)
-            for i in range(0,self.verts):
-                vertp = self.verts[i]
-                xvert,yvert = zip(*vertp)
-                points = np.ones((len(yvert),2))
-                points[:,0] = xvert
-                points[:,1] = yvert
-                p = path.Path(points)
-                psum = psum | p.contains_points(points)
-
-            return psum
+
+        Points outside the bounding box of a part are rejected with array masks before that
+        part's containment test is run on the remaining points.
+        @param x: X coordinates of points (any shape).
+        @param y: Y coordinates of points (same shape as x).
+        @keyword evenodd: If False, a point is inside the polygon if it is inside any part.  If True,
+                          a point is inside if it is inside an odd number of parts, so that parts
+                          lying within other parts act as holes.
+        @return: Numpy boolean array of same shape as X and Y, True where inside, False where outside.
+        """
+        x = np.asarray(x,dtype=np.float64)
+        y = np.asarray(y,dtype=np.float64)
+        xf = x.ravel()
+        yf = y.ravel()
+        inside = np.zeros(xf.shape,dtype=np.bool_)
+        candidates = np.flatnonzero((xf >= self.xmin) & (xf <= self.xmax) & (yf >= self.ymin) & (yf <= self.ymax))
+        cx = xf[candidates]
+        cy = yf[candidates]
+        for i in range(0,self.nparts):
+            pxmin,pxmax,pymin,pymax = self.partbounds[i]
+            inbox = (cx >= pxmin) & (cx <= pxmax) & (cy >= pymin) & (cy <= pymax)
+            if not evenodd:
+                inbox &= ~inside[candidates]
+            pidx = np.flatnonzero(inbox)
+            if not len(pidx):
+                continue
+            pinside = self.paths[i].contains_points(np.column_stack((cx[pidx],cy[pidx])))
+            if evenodd:
+                inside[candidates[pidx]] ^= pinside
+            else:
+                inside[candidates[pidx]] |= pinside
+        return inside.reshape(x.shape)
 
     def __repr__(self):
         """
@@ -138,24 +142,229 @@ class PagerPolygon(object):
         fmt = '<PagerPolygon (xmin=%g,xmax=%g,ymin=%g,ymax=%g)>'
         return fmt % (self.xmin,self.xmax,self.ymin,self.ymax)
 
+class PolygonIndex(object):
+    """
+    Spatial index over a collection of PagerPolygon objects, for mapping many points to the polygon containing each.
+
+    The combined extent of the polygons is divided into a uniform grid of cells, and each cell
+    lists the polygons whose bounding boxes overlap it.  Points are matched to cells (and then
+    to bounding boxes) with array operations, and only points that fall in at least one polygon's
+    bounding box are given an exact point-in-polygon test.
+    """
+    def __init__(self,polygons,nx=None,ny=None):
+        """
+        Construct a PolygonIndex.
+        @param polygons: Sequence of PagerPolygon objects.
+        @keyword nx: Number of grid cells in the x direction (defaults to about 2*sqrt(number of polygons)).
+        @keyword ny: Number of grid cells in the y direction (defaults to nx).
+        """
+        self.polygons = list(polygons)
+        npoly = len(self.polygons)
+        if nx is None:
+            nx = max(1,int(np.ceil(2*np.sqrt(npoly))))
+        if ny is None:
+            ny = nx
+        self.nx = nx
+        self.ny = ny
+        self.bounds = np.zeros((npoly,4))
+        for i in range(0,npoly):
+            self.bounds[i] = self.polygons[i].bounds
+        if npoly:
+            self.xmin = self.bounds[:,0].min()
+            self.xmax = self.bounds[:,1].max()
+            self.ymin = self.bounds[:,2].min()
+            self.ymax = self.bounds[:,3].max()
+        else:
+            self.xmin = self.xmax = self.ymin = self.ymax = 0.0
+        self.xdim = max(self.xmax - self.xmin,1e-12)/nx
+        self.ydim = max(self.ymax - self.ymin,1e-12)/ny
+        #polygons overlapping cell c are cellpolys[cellstart[c]:cellstart[c+1]], in increasing order
+        cells = []
+        polys = []
+        for i in range(0,npoly):
+            pxmin,pxmax,pymin,pymax = self.bounds[i]
+            c0,r0 = self._getCell(pxmin,pymin)
+            c1,r1 = self._getCell(pxmax,pymax)
+            cc,rr = np.meshgrid(np.arange(c0,c1+1),np.arange(r0,r1+1))
+            cells.append((rr*nx + cc).ravel())
+            polys.append(np.ones(cc.size,dtype=np.intp)*i)
+        if npoly:
+            cells = np.concatenate(cells)
+            polys = np.concatenate(polys)
+        else:
+            cells = np.zeros(0,dtype=np.intp)
+            polys = np.zeros(0,dtype=np.intp)
+        order = np.lexsort((polys,cells))
+        self.cellpolys = polys[order]
+        self.cellstart = np.zeros(nx*ny+1,dtype=np.intp)
+        self.cellstart[1:] = np.cumsum(np.bincount(cells,minlength=nx*ny))
+
+    def _getCell(self,x,y):
+        """
+        Return the grid column and row for coordinates inside the index extent.
+        """
+        col = np.clip(np.floor((x - self.xmin)/self.xdim).astype(np.intp),0,self.nx-1)
+        row = np.clip(np.floor((y - self.ymin)/self.ydim).astype(np.intp),0,self.ny-1)
+        return (col,row)
+
+    def getContainingPolygon(self,x,y,evenodd=False):
+        """
+        Find the polygon containing each of a set of points.
+        @param x: X coordinates of points (any shape).
+        @param y: Y coordinates of points (same shape as x).
+        @keyword evenodd: Hole semantics passed to PagerPolygon.containsPoints().
+        @return: Numpy integer array of same shape as x, holding the index (into the sequence of
+                 polygons used to build the index) of the polygon containing each point, or -1 for
+                 points outside all polygons.  Where polygons overlap, the lowest index wins.
+        """
+        x = np.asarray(x,dtype=np.float64)
+        y = np.asarray(y,dtype=np.float64)
+        xf = x.ravel()
+        yf = y.ravel()
+        result = -np.ones(xf.shape,dtype=np.intp)
+        points = np.flatnonzero((xf >= self.xmin) & (xf <= self.xmax) & (yf >= self.ymin) & (yf <= self.ymax))
+        if not len(points) or not len(self.polygons):
+            return result.reshape(x.shape)
+        col,row = self._getCell(xf[points],yf[points])
+        cell = row*self.nx + col
+        #expand each point into one (point,polygon) pair per polygon listed in its cell
+        counts = self.cellstart[cell+1] - self.cellstart[cell]
+        pairpoint = np.repeat(points,counts)
+        firstpair = np.cumsum(counts) - counts
+        pairpos = np.arange(counts.sum()) - np.repeat(firstpair,counts) + np.repeat(self.cellstart[cell],counts)
+        pairpoly = self.cellpolys[pairpos]
+        px = xf[pairpoint]
+        py = yf[pairpoint]
+        pb = self.bounds[pairpoly]
+        inbox = (px >= pb[:,0]) & (px <= pb[:,1]) & (py >= pb[:,2]) & (py <= pb[:,3])
+        pairpoint = pairpoint[inbox]
+        pairpoly = pairpoly[inbox]
+        #exact tests, polygon by polygon in increasing order, skipping points already matched
+        order = np.argsort(pairpoly,kind='mergesort')
+        pairpoint = pairpoint[order]
+        pairpoly = pairpoly[order]
+        polyids,starts = np.unique(pairpoly,return_index=True)
+        stops = np.append(starts[1:],len(pairpoly))
+        for i in range(0,len(polyids)):
+            ipoints = pairpoint[starts[i]:stops[i]]
+            ipoints = ipoints[result[ipoints] < 0]
+            if not len(ipoints):
+                continue
+            inside = self.polygons[polyids[i]].containsPoints(xf[ipoints],yf[ipoints],evenodd=evenodd)
+            result[ipoints[inside]] = polyids[i]
+        return result.reshape(x.shape)
+
 def inmultipoly(x,y,verts):
     """
     Convenience function for calculating point-in-polygon for 2D x,y arrays.
+
+    For points on a regular grid, getPolygonMask() is much faster.
     @param x: 2D array of x values.
     @param y: 2D array of y values.
     @param verts: sequence of (x,y) tuples.
     @return: Numpy 2D array of boolean values indicating which x,y values are inside vertices.
     """
     m,n = x.shape
-    x = x.reshape(m*n,1)
-    y = y.reshape(m*n,1)
-    points = squeeze(np.array(zip(x,y)))
-    xvert,yvert = zip(*verts)
-    points = np.ones((len(yvert),2))
-    points[:,0] = xvert
-    points[:,1] = yvert
-    p = path.Path(points)
+    points = np.column_stack((np.ravel(x),np.ravel(y)))
+    p = path.Path(np.array(verts,dtype=np.float64))
     inside = p.contains_points(points)
     inside = inside.reshape(m,n)
     return inside
 
+def _rasterizePolygon(polygon,geodict,evenodd=False):
+    """
+    Scanline rasterize a PagerPolygon onto the rows of a grid that its bounding box covers.
+    @return: Tuple of (startrow,mask), where mask is a boolean array of the grid rows from startrow
+             onwards that the polygon can touch (mask may have zero rows).
+    """
+    xmin = geodict['xmin']
+    ymax = geodict['ymax']
+    xdim = geodict['xdim']
+    ydim = geodict['ydim']
+    nrows = geodict['nrows']
+    ncols = geodict['ncols']
+    #edges of every part, including the edge that closes each part
+    x0 = []
+    y0 = []
+    x1 = []
+    y1 = []
+    part = []
+    for i in range(0,polygon.nparts):
+        pxy = polygon.xy[polygon.partoff[i]:polygon.partoff[i+1]]
+        x0.append(pxy[:,0])
+        y0.append(pxy[:,1])
+        x1.append(np.roll(pxy[:,0],-1))
+        y1.append(np.roll(pxy[:,1],-1))
+        part.append(np.ones(len(pxy),dtype=np.intp)*i)
+    x0 = np.concatenate(x0)
+    y0 = np.concatenate(y0)
+    x1 = np.concatenate(x1)
+    y1 = np.concatenate(y1)
+    part = np.concatenate(part)
+    sloping = y1 != y0
+    x0 = x0[sloping]
+    y0 = y0[sloping]
+    y1 = y1[sloping]
+    part = part[sloping]
+    dxdy = (x1[sloping] - x0)/(y1 - y0)
+
+    startrow = max(0,int(np.ceil((ymax - polygon.ymax)/ydim)))
+    endrow = min(nrows-1,int(np.floor((ymax - polygon.ymin)/ydim)))
+    mask = np.zeros((max(endrow-startrow+1,0),ncols),dtype=np.bool_)
+    for i in range(startrow,endrow+1):
+        y = ymax - i*ydim
+        #half-open rule, so a row passing through a vertex counts it once
+        crosses = np.flatnonzero((y0 > y) != (y1 > y))
+        if not len(crosses):
+            continue
+        xc = x0[crosses] + (y - y0[crosses])*dxdy[crosses]
+        #a crossing toggles the inside state of every column to its right
+        pos = np.clip(np.floor((xc - xmin)/xdim).astype(np.intp) + 1,0,ncols)
+        if evenodd:
+            toggles = np.bincount(pos,minlength=ncols+1)[0:ncols]
+            mask[i-startrow] = np.cumsum(toggles) & 1
+        else:
+            parts,ipart = np.unique(part[crosses],return_inverse=True)
+            toggles = np.bincount(ipart*(ncols+1) + pos,minlength=len(parts)*(ncols+1))
+            toggles = toggles.reshape(len(parts),ncols+1)[:,0:ncols]
+            mask[i-startrow] = (np.cumsum(toggles,axis=1) & 1).any(axis=0)
+    return (startrow,mask)
+
+def getPolygonMask(polygon,geodict,evenodd=False):
+    """
+    Find which nodes of a regular grid are inside a PagerPolygon, using a scanline (edge crossing) rasterizer.
+
+    Each grid row is intersected with the polygon edges, and the crossings are turned into runs
+    of inside columns, so the cost is O(rows x edges) and no per-node coordinates are created.
+    @param polygon: PagerPolygon object.
+    @param geodict: Dictionary describing the grid, with at least the following keys:
+                    - xmin   X coordinate of the first column of nodes.
+                    - ymax   Y coordinate of the first (top) row of nodes.
+                    - xdim   Spacing of columns.
+                    - ydim   Spacing of rows.
+                    - nrows  Number of rows.
+                    - ncols  Number of columns.
+    @keyword evenodd: If False, a node is inside if it is inside any part of the polygon.  If True,
+                      parts lying within other parts act as holes (see PagerPolygon.containsPoints()).
+    @return: Numpy (nrows,ncols) boolean array, True where nodes are inside the polygon.
+    """
+    mask = np.zeros((geodict['nrows'],geodict['ncols']),dtype=np.bool_)
+    startrow,pmask = _rasterizePolygon(polygon,geodict,evenodd=evenodd)
+    mask[startrow:startrow+len(pmask)] = pmask
+    return mask
+
+def getPolygonLabels(polygons,geodict,evenodd=False):
+    """
+    Label the nodes of a regular grid with the index of the PagerPolygon containing them.
+    @param polygons: Sequence of PagerPolygon objects.
+    @param geodict: Dictionary describing the grid (see getPolygonMask()).
+    @keyword evenodd: Hole semantics (see getPolygonMask()).
+    @return: Numpy (nrows,ncols) integer array, holding the index of the polygon containing each node,
+             or -1 for nodes outside all polygons.  Where polygons overlap, the lowest index wins.
+    """
+    labels = -np.ones((geodict['nrows'],geodict['ncols']),dtype=np.intp)
+    for i in range(0,len(polygons)):
+        startrow,pmask = _rasterizePolygon(polygons[i],geodict,evenodd=evenodd)
+        block = labels[startrow:startrow+len(pmask)]
+        block[pmask & (block < 0)] = i
+    return labels
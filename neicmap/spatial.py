@@ -0,0 +1,114 @@
+#!/usr/bin/python
+import numpy
+from scipy.spatial import cKDTree
+from neicmap.distance import sdist,cosd,sind
+
+#radius of the earth in meters, same spherical earth used by neicmap.distance.sdist
+EARTH_RADIUS = 6367*1e3
+
+def getUnitVectors(lat,lon):
+    """
+    Convert latitude/longitude to unit vectors (x,y,z) on a spherical Earth.
+    @param lat: Latitude(s) of point(s).
+    @param lon: Longitude(s) of point(s).
+    @return: Numpy array of shape (N,3), one unit vector per input point.
+    """
+    lat = numpy.atleast_1d(numpy.asarray(lat,dtype=numpy.float64))
+    lon = numpy.atleast_1d(numpy.asarray(lon,dtype=numpy.float64))
+    xyz = numpy.empty((len(lat),3))
+    coslat = cosd(lat)
+    xyz[:,0] = coslat*cosd(lon)
+    xyz[:,1] = coslat*sind(lon)
+    xyz[:,2] = sind(lat)
+    return xyz
+
+def getChordLength(dist):
+    """
+    Convert great circle distance to straight line (chord) distance on the unit sphere.
+    @param dist: Great circle distance(s) in meters.
+    @return: Chord length(s) on the unit sphere, capped at 2 (antipodal points).
+    """
+    angle = numpy.minimum(numpy.asarray(dist,dtype=numpy.float64)/EARTH_RADIUS,numpy.pi)
+    return 2*numpy.sin(angle/2)
+
+class SphericalIndex(object):
+    """
+    Spatial index over a fixed set of latitude/longitude points.
+
+    Points are stored as unit vectors in a 3D KD-tree, so searches need no special handling
+    near the poles or across the antimeridian.  The tree only selects candidate points;
+    returned distances (and the radius test) are computed exactly with neicmap.distance.sdist.
+    """
+    def __init__(self,lat,lon,leafsize=16):
+        """
+        Build a SphericalIndex.
+        @param lat: Numpy array of point latitudes.
+        @param lon: Numpy array of point longitudes.
+        @keyword leafsize: Number of points at which the KD-tree switches to brute force.
+        """
+        self.lat = numpy.asarray(lat,dtype=numpy.float64)
+        self.lon = numpy.asarray(lon,dtype=numpy.float64)
+        #cKDTree cannot be built over zero points
+        self.tree = None
+        if len(self.lat):
+            self.tree = cKDTree(getUnitVectors(self.lat,self.lon),leafsize=leafsize)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def queryRadius(self,lat,lon,radius):
+        """
+        Find indexed points within a great circle distance of a point.
+        @param lat: Latitude of center of search radius.
+        @param lon: Longitude of center of search radius.
+        @param radius: Search radius in meters.
+        @return: Tuple of (indices,distances), where indices is a sorted integer array of
+                 points inside the search radius and distances is their distance in meters.
+        """
+        if self.tree is None:
+            return (numpy.zeros(0,dtype=numpy.intp),numpy.zeros(0))
+        #pad the chord a little so that rounding never drops a point sdist would keep
+        chord = getChordLength(radius)*(1+1e-9) + 1e-12
+        xyz = getUnitVectors(lat,lon)[0]
+        idx = numpy.array(self.tree.query_ball_point(xyz,chord),dtype=numpy.intp)
+        idx.sort()
+        dist = sdist(lat,lon,self.lat[idx],self.lon[idx])
+        inside = dist <= radius
+        return (idx[inside],dist[inside])
+
+    def queryNearest(self,lat,lon,k,mask=None):
+        """
+        Find the k indexed points nearest to a point.
+        @param lat: Latitude of search point.
+        @param lon: Longitude of search point.
+        @param k: Number of points to find.
+        @keyword mask: Optional boolean array (one element per indexed point); only points
+                       where mask is True are considered.
+        @return: Tuple of (indices,distances), ordered by increasing distance (meters), with
+                 ties broken by index.  Fewer than k points are returned if fewer are available.
+        """
+        npoints = len(self)
+        if mask is not None:
+            mask = numpy.asarray(mask,dtype=numpy.bool_)
+            navail = mask.sum()
+        else:
+            navail = npoints
+        k = min(k,navail)
+        if k <= 0:
+            return (numpy.zeros(0,dtype=numpy.intp),numpy.zeros(0))
+        xyz = getUnitVectors(lat,lon)[0]
+        #ask the tree for a few extra points so ties at the k-th distance are resolved exactly,
+        #and keep widening the search until enough points survive the mask
+        ntarget = min(k+8,navail)
+        nquery = min(k+8,npoints)
+        while True:
+            chords,idx = self.tree.query(xyz,nquery)
+            idx = numpy.atleast_1d(idx)
+            if mask is not None:
+                idx = idx[mask[idx]]
+            if len(idx) >= ntarget or nquery == npoints:
+                break
+            nquery = min(nquery*4,npoints)
+        dist = sdist(lat,lon,self.lat[idx],self.lon[idx])
+        order = numpy.lexsort((idx,dist))[0:k]
+        return (idx[order],dist[order])
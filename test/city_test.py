@@ -0,0 +1,194 @@
+#!/usr/bin/python
+"""
+Equivalence tests for the PAGER city table selection in neicmap.city.
+
+The reference functions below are a frozen copy of the cmp-based sortCities(),
+removeDuplicateCities() and getCityTable() that preceded the key array implementation,
+and the current methods must reproduce their output exactly.
+"""
+import os.path
+import sys
+import re
+import copy
+import random
+import warnings
+
+homedir = os.path.dirname(os.path.abspath(__file__)) #where is this script?
+sys.path.insert(0,os.path.dirname(homedir)) #put the package root at the front of the path
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore',DeprecationWarning)
+    from sets import Set
+
+from neicmap.city import PagerCity
+
+NTRIALS = 3000
+
+#########################################################################################
+#Frozen reference implementation (do not "fix" - it defines the expected output)
+#########################################################################################
+def refSortCitiesByMMI(city1,city2):
+    return cmp(city1['mmi'],city2['mmi'])
+
+def refSortCitiesByPopulation(city1,city2):
+    return cmp(city1['pop'],city2['pop'])
+
+def refSortCitiesByCapital(city1,city2):
+    c = cmp(city1['iscap'],city2['iscap'])
+    if c != 0:
+        return c
+    else:
+        return cmp(city1['pop'],city2['pop'])
+
+def refSortCities(citylist,method=None):
+    if len(citylist) == 0:
+        return citylist
+    if method==None:
+        citylist.sort(refSortCitiesByPopulation)
+        return citylist
+    method = method.lower()
+    popmatch = re.compile('pop')
+    capmatch = re.compile('cap')
+    haspop = popmatch.search(method)
+    hascap = capmatch.search(method)
+    if hascap:
+        citylist.sort(refSortCitiesByCapital,reverse=True)
+        return citylist
+    elif haspop:
+        citylist.sort(refSortCitiesByPopulation,reverse=True)
+        return citylist
+    else:
+        citylist.sort(refSortCitiesByMMI,reverse=True)
+    return citylist
+
+def refRemoveDuplicateCities(allcities,citylist1,method,maxlen):
+    c1names = [city['name'] for city in citylist1]
+    citylist2 = refSortCities(allcities,method=method)
+    allnames = [city['name'] for city in allcities]
+    c2names = [city['name'] for city in citylist2]
+    dupcities = list(Set(c1names).intersection(c2names))
+    while len(dupcities) > 0:
+        for dup in dupcities:
+            dupidx = allnames.index(dup)
+            allcities.pop(dupidx)
+            allnames = [city['name'] for city in allcities]
+        citylist2 = refSortCities(allcities,method=method)
+        allnames = [city['name'] for city in allcities]
+        c2names = [city['name'] for city in citylist2]
+        dupcities = list(Set(c1names).intersection(c2names))
+    if len(citylist2) > maxlen:
+        citylist2 = citylist2[0:maxlen]
+    return (citylist2,allcities)
+
+def refGetCityTable(citylist):
+    NMax = 6
+    MMax = 5
+    NTotal = 11
+    mmicities = refSortCities(citylist,method='mmi')
+    if len(mmicities) < NMax:
+        return mmicities
+    mmicities = citylist[0:NMax]
+    capcities,citylist = refRemoveDuplicateCities(citylist,mmicities,'capital',MMax)
+    capcities2 = []
+    for city in capcities:
+        if city['iscap']:
+            capcities2.append(city)
+    combined_cities = mmicities + capcities2
+    if len(combined_cities) == NTotal:
+        return refSortCities(combined_cities,method='mmi')
+    ncities = len(combined_cities)
+    popcities,citylist = refRemoveDuplicateCities(citylist,combined_cities,'population',NTotal-ncities)
+    combined_cities = combined_cities + popcities
+    return refSortCities(combined_cities,method='mmi')
+
+#########################################################################################
+#Helpers
+#########################################################################################
+def getRandomCities(ncities,rand):
+    """
+    Make a list of random cities, with many ties in MMI, population and capital status,
+    and (often) repeated names.
+    """
+    nnames = rand.choice([2,5,ncities+1,1000])
+    popmax = rand.choice([3,100,10000000])
+    capfrac = rand.choice([0.0,0.1,0.5,1.0])
+    integermmi = rand.random() < 0.5
+    citylist = []
+    for i in range(0,ncities):
+        if integermmi:
+            mmi = float(rand.randrange(1,10))
+        else:
+            mmi = rand.uniform(1.0,10.0)
+        citylist.append({'name':'City%i' % rand.randrange(nnames),
+                         'ccode':'US',
+                         'lat':rand.uniform(-90,90),
+                         'lon':rand.uniform(-180,180),
+                         'iscap':rand.random() < capfrac,
+                         'pop':rand.randrange(popmax),
+                         'mmi':mmi})
+    return citylist
+
+def getIds(citylist):
+    return [id(city) for city in citylist]
+
+#list lengths below 6, exactly 6, between 6 and 11, and above 11
+LENGTHS = [0,1,2,5,6,7,9,11,12,15,30,100,500]
+
+#########################################################################################
+#Tests
+#########################################################################################
+def test_getCityTable():
+    rand = random.Random(1234)
+    pc = PagerCity()
+    for i in range(0,NTRIALS):
+        citylist = getRandomCities(LENGTHS[i % len(LENGTHS)],rand)
+        reference = refGetCityTable(list(citylist))
+        table = pc.getCityTable(citylist)
+        #same city objects, in the same order
+        assert getIds(table) == getIds(reference),'Trial %i: city tables differ' % i
+
+def test_getCityTableInputUnmodified():
+    rand = random.Random(5678)
+    pc = PagerCity()
+    for ncities in LENGTHS:
+        citylist = getRandomCities(ncities,rand)
+        before = getIds(citylist)
+        cities = copy.deepcopy(citylist)
+        pc.getCityTable(citylist)
+        assert getIds(citylist) == before,'getCityTable reordered or trimmed its input'
+        assert citylist == cities,'getCityTable modified the input city dictionaries'
+
+def test_removeDuplicateCities():
+    rand = random.Random(4321)
+    pc = PagerCity()
+    for i in range(0,NTRIALS/3):
+        citylist = getRandomCities(LENGTHS[i % len(LENGTHS)],rand)
+        citylist1 = rand.sample(citylist,min(len(citylist),rand.randrange(0,12)))
+        for method in ['capital','population','mmi']:
+            maxlen = rand.randrange(0,12)
+            allcities1 = list(citylist)
+            allcities2 = list(citylist)
+            ref,refall = refRemoveDuplicateCities(allcities1,citylist1,method,maxlen)
+            sub,suball = pc.removeDuplicateCities(allcities2,citylist1,method,maxlen)
+            assert getIds(sub) == getIds(ref),'Trial %i (%s): selected cities differ' % (i,method)
+            assert getIds(suball) == getIds(refall),'Trial %i (%s): remaining cities differ' % (i,method)
+            #both modify allcities in place
+            assert getIds(allcities2) == getIds(allcities1)
+
+def test_sortCities():
+    rand = random.Random(8765)
+    pc = PagerCity()
+    for i in range(0,NTRIALS/3):
+        citylist = getRandomCities(LENGTHS[i % len(LENGTHS)],rand)
+        for method in [None,'population','capital','mmi','Pop','CAPITAL']:
+            reference = refSortCities(list(citylist),method=method)
+            order = pc.getCitySortOrder(citylist,method=method)
+            assert getIds([citylist[j] for j in order]) == getIds(reference)
+            assert getIds(pc.sortCities(list(citylist),method=method)) == getIds(reference)
+
+if __name__ == '__main__':
+    test_getCityTable()
+    test_getCityTableInputUnmodified()
+    test_removeDuplicateCities()
+    test_sortCities()
+    print 'All tests passed.'
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+"""
+Tests for the binary city cache written and read by neicmap.citystore.CityStore, and its use by
+PagerCity.loadCities().
+"""
+import os
+import os.path
+import sys
+import random
+import shutil
+import tempfile
+
+homedir = os.path.dirname(os.path.abspath(__file__)) #where is this script?
+sys.path.insert(0,os.path.dirname(homedir)) #put the package root at the front of the path
+
+import numpy
+from neicmap.citystore import CityStore,CityStoreError,CACHE_HEADER_SIZE
+from neicmap.city import PagerCity
+
+#########################################################################################
+#Helpers
+#########################################################################################
+def getRandomStore(ncities,rand):
+    names = ['City%i' % rand.randrange(1000) + 'x'*rand.randrange(20) for i in range(0,ncities)]
+    ccodes = [rand.choice(['US','JP','CL','NZ','']) for i in range(0,ncities)]
+    lat = [rand.uniform(-90,90) for i in range(0,ncities)]
+    lon = [rand.uniform(-180,180) for i in range(0,ncities)]
+    pop = [rand.randrange(10000000) for i in range(0,ncities)]
+    iscap = [rand.random() < 0.1 for i in range(0,ncities)]
+    return CityStore(names,ccodes,lat,lon,pop,iscap)
+
+def writeCityFile(cityfile,ncities,rand):
+    """
+    Write a small GeoNames style cities file.
+    """
+    f = open(cityfile,'wt')
+    for i in range(0,ncities):
+        parts = [str(i),'City%i' % i,'City%i' % i,'',
+                 repr(rand.uniform(-90,90)),repr(rand.uniform(-180,180)),
+                 'P',rand.choice(['PPL','PPLA','PPLC']),rand.choice(['US','JP','CL']),
+                 '','','','','',str(rand.choice([500,5000,50000,500000])),'','','UTC','2012-01-01']
+        f.write('\t'.join(parts)+'\n')
+    f.close()
+
+def assertStoresEqual(store1,store2):
+    assert len(store1) == len(store2)
+    for column in CityStore.COLUMNS:
+        data1 = getattr(store1,column)
+        data2 = getattr(store2,column)
+        assert data1.dtype == data2.dtype,'Column %s changed type' % column
+        assert numpy.array_equal(data1,data2),'Column %s changed' % column
+    assert store1.getCities() == store2.getCities()
+
+def assertRaises(exception,function,*args,**kwargs):
+    try:
+        function(*args,**kwargs)
+    except exception:
+        return
+    raise AssertionError,'%s did not raise %s' % (function.__name__,exception.__name__)
+
+def isCached(pagercity):
+    """
+    Check whether a PagerCity's cities were memory-mapped from a cache file, rather than parsed.
+    """
+    return isinstance(pagercity.store.lat.base,numpy.memmap)
+
+#########################################################################################
+#Tests
+#########################################################################################
+def test_roundTrip():
+    rand = random.Random(1234)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for ncities in [1,2,10,1000]:
+            store = getRandomStore(ncities,rand)
+            cachefile = os.path.join(tmpdir,'cities%i.cache' % ncities)
+            store.save(cachefile,sourcekey='key%i' % ncities)
+            store2 = CityStore.load(cachefile,sourcekey='key%i' % ncities)
+            assertStoresEqual(store,store2)
+            #columns are read-only maps of the file
+            assert not store2.lat.flags.writeable
+            assert isinstance(store2.lat.base,numpy.memmap)
+            #the source key is only checked when given
+            assertStoresEqual(store,CityStore.load(cachefile))
+        #no temporary files are left behind
+        assert sorted(os.listdir(tmpdir)) == ['cities1.cache','cities10.cache','cities1000.cache','cities2.cache']
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_emptyStore():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = CityStore([],[],[],[],[],[])
+        cachefile = os.path.join(tmpdir,'empty.cache')
+        store.save(cachefile,sourcekey='empty')
+        store2 = CityStore.load(cachefile,sourcekey='empty')
+        assert len(store2) == 0
+        assert store2.getCities() == []
+        for column in CityStore.COLUMNS:
+            assert getattr(store2,column).dtype == getattr(store,column).dtype
+        assert list(store2.nameoff) == [0]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_invalidCache():
+    rand = random.Random(4321)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = getRandomStore(100,rand)
+        cachefile = os.path.join(tmpdir,'cities.cache')
+        store.save(cachefile,sourcekey='1000:1.5')
+        #out of date
+        assertRaises(CityStoreError,CityStore.load,cachefile,sourcekey='1000:2.5')
+        #missing
+        assertRaises(CityStoreError,CityStore.load,os.path.join(tmpdir,'missing.cache'))
+        #truncated
+        data = open(cachefile,'rb').read()
+        truncfile = os.path.join(tmpdir,'truncated.cache')
+        open(truncfile,'wb').write(data[0:len(data)-100])
+        assertRaises(CityStoreError,CityStore.load,truncfile)
+        #header only
+        open(truncfile,'wb').write(data[0:CACHE_HEADER_SIZE])
+        assertRaises(CityStoreError,CityStore.load,truncfile)
+        #written by a different version
+        versionfile = os.path.join(tmpdir,'version.cache')
+        header = data[0:CACHE_HEADER_SIZE].split('\n')
+        magic,version = header[0].split()
+        header[0] = '%s %i' % (magic,int(version)+1)
+        open(versionfile,'wb').write('\n'.join(header) + data[CACHE_HEADER_SIZE:])
+        assertRaises(CityStoreError,CityStore.load,versionfile)
+        #not a cache at all
+        textfile = os.path.join(tmpdir,'cities.txt')
+        writeCityFile(textfile,10,rand)
+        assertRaises(CityStoreError,CityStore.load,textfile)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_saveFailure():
+    rand = random.Random(8765)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = getRandomStore(100,rand)
+        #the cache file cannot replace a directory, so the final rename fails
+        cachefile = os.path.join(tmpdir,'cities.cache')
+        os.mkdir(cachefile)
+        open(os.path.join(cachefile,'keep'),'w').close()
+        assertRaises(OSError,store.save,cachefile)
+        #no partial temporary file is left behind
+        assert os.listdir(tmpdir) == ['cities.cache']
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_loadCitiesCache():
+    rand = random.Random(5678)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cityfile = os.path.join(tmpdir,'cities1000.txt')
+        writeCityFile(cityfile,500,rand)
+        pc1 = PagerCity(cityfile)
+        assert pc1.cachefile == cityfile + '.cache'
+        assert os.path.isfile(pc1.cachefile)
+        assert not isCached(pc1)
+        pc2 = PagerCity(cityfile)
+        assert isCached(pc2)
+        assert pc1.cities == pc2.cities
+        #modifying the city file makes the cache out of date
+        writeCityFile(cityfile,400,rand)
+        st = os.stat(cityfile)
+        os.utime(cityfile,(st.st_atime,st.st_mtime+10))
+        pc3 = PagerCity(cityfile)
+        assert not isCached(pc3)
+        assert len(pc3.cities) == 400
+        assert isCached(PagerCity(cityfile))
+        #no cache is used
+        pc4 = PagerCity()
+        pc4.loadCities(cityfile,usecache=False)
+        assert not isCached(pc4)
+        assert pc4.cachefile is None
+        assert pc4.cities == pc3.cities
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_loadCitiesFilteredCache():
+    rand = random.Random(9876)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cityfile = os.path.join(tmpdir,'cities1000.txt')
+        writeCityFile(cityfile,500,rand)
+        full = PagerCity(cityfile).cities
+        nbig = len([city for city in full if city['pop'] >= 50000])
+        njp = len([city for city in full if city['ccode'] == 'JP'])
+        #filtered loads do not read or write the default cache
+        os.remove(cityfile + '.cache')
+        pc = PagerCity()
+        pc.loadCities(cityfile,minpop=50000)
+        assert len(pc.cities) == nbig
+        assert pc.cachefile is None
+        assert not os.path.isfile(cityfile + '.cache')
+        #unless a cache file is given, which is keyed by the filters
+        cachefile = os.path.join(tmpdir,'filtered.cache')
+        pc.loadCities(cityfile,minpop=50000,cachefile=cachefile)
+        assert not isCached(pc)
+        assert pc.cachefile == cachefile
+        pc.loadCities(cityfile,minpop=50000,cachefile=cachefile)
+        assert isCached(pc)
+        assert len(pc.cities) == nbig
+        #different filters do not reuse it
+        pc.loadCities(cityfile,ccodes=['jp'],cachefile=cachefile)
+        assert not isCached(pc)
+        assert len(pc.cities) == njp
+        pc.loadCities(cityfile,minpop=50000,cachefile=cachefile)
+        assert not isCached(pc)
+        assert len(pc.cities) == nbig
+        #and an unfiltered load with the same cache file does not reuse a filtered cache
+        pc.loadCities(cityfile,cachefile=cachefile)
+        assert not isCached(pc)
+        assert pc.cities == full
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test_roundTrip()
+    test_emptyStore()
+    test_invalidCache()
+    test_saveFailure()
+    test_loadCitiesCache()
+    test_loadCitiesFilteredCache()
+    print 'All tests passed.'
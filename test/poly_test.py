@@ -0,0 +1,124 @@
+#!/usr/bin/python
+"""
+Tests for the grid rasterizer in neicmap.poly.
+
+getPolygonMask() and getPolygonLabels() must agree node for node with PagerPolygon.containsPoints()
+evaluated at the grid node coordinates.
+"""
+import os.path
+import sys
+import random
+
+homedir = os.path.dirname(os.path.abspath(__file__)) #where is this script?
+sys.path.insert(0,os.path.dirname(homedir)) #put the package root at the front of the path
+
+import numpy
+from neicmap.poly import PagerPolygon,getPolygonMask,getPolygonLabels
+
+NTRIALS = 200
+
+#########################################################################################
+#Helpers
+#########################################################################################
+def getRandomStar(xc,yc,radius,rand):
+    """
+    Make a random star-shaped ring of vertices (with concave and possibly self-touching edges).
+    """
+    nverts = rand.randrange(3,30)
+    angles = sorted([rand.uniform(0,2*numpy.pi) for i in range(0,nverts)])
+    radii = [rand.uniform(0.2,1.0)*radius for i in range(0,nverts)]
+    x = [xc + r*numpy.cos(a) for r,a in zip(radii,angles)]
+    y = [yc + r*numpy.sin(a) for r,a in zip(radii,angles)]
+    return (x,y)
+
+def getRandomRectangle(xc,yc,radius,rand):
+    """
+    Make a rectangle, which has horizontal edges.
+    """
+    x0 = xc - rand.uniform(0.1,1.0)*radius
+    x1 = xc + rand.uniform(0.1,1.0)*radius
+    y0 = yc - rand.uniform(0.1,1.0)*radius
+    y1 = yc + rand.uniform(0.1,1.0)*radius
+    return ([x0,x1,x1,x0],[y0,y0,y1,y1])
+
+def getRandomPolygon(rand):
+    """
+    Make a random PagerPolygon of one to four parts, some of which may lie within (or overlap) others.
+    """
+    xp = []
+    yp = []
+    xc = rand.uniform(-10,10)
+    yc = rand.uniform(-10,10)
+    radius = rand.uniform(0.5,8)
+    for i in range(0,rand.choice([1,1,2,3,4])):
+        if rand.random() < 0.5:
+            #a part inside or overlapping the first one
+            pxc = xc + rand.uniform(-0.5,0.5)*radius
+            pyc = yc + rand.uniform(-0.5,0.5)*radius
+            pradius = rand.uniform(0.1,0.5)*radius
+        else:
+            pxc = rand.uniform(-10,10)
+            pyc = rand.uniform(-10,10)
+            pradius = rand.uniform(0.5,8)
+        if rand.random() < 0.2:
+            x,y = getRandomRectangle(pxc,pyc,pradius,rand)
+        else:
+            x,y = getRandomStar(pxc,pyc,pradius,rand)
+        if len(xp):
+            xp.append(numpy.nan)
+            yp.append(numpy.nan)
+        xp += x
+        yp += y
+    return PagerPolygon(xp,yp)
+
+def getRandomGeodict(rand):
+    """
+    Make a random grid, which may cover all, part or none of the polygons.
+    """
+    xdim = rand.uniform(0.05,1.0)
+    ydim = rand.choice([xdim,rand.uniform(0.05,1.0)])
+    return {'xmin':rand.uniform(-20,5),'ymax':rand.uniform(-5,20),'xdim':xdim,'ydim':ydim,
+            'nrows':rand.randrange(1,200),'ncols':rand.randrange(1,200)}
+
+def getNodes(geodict):
+    x = geodict['xmin'] + numpy.arange(0,geodict['ncols'])*geodict['xdim']
+    y = geodict['ymax'] - numpy.arange(0,geodict['nrows'])*geodict['ydim']
+    return numpy.meshgrid(x,y)
+
+#########################################################################################
+#Tests
+#########################################################################################
+def test_getPolygonMask():
+    rand = random.Random(1234)
+    for i in range(0,NTRIALS):
+        polygon = getRandomPolygon(rand)
+        geodict = getRandomGeodict(rand)
+        x,y = getNodes(geodict)
+        for evenodd in [False,True]:
+            mask = getPolygonMask(polygon,geodict,evenodd=evenodd)
+            assert mask.shape == (geodict['nrows'],geodict['ncols'])
+            assert mask.dtype == numpy.bool_
+            inside = polygon.containsPoints(x,y,evenodd=evenodd)
+            assert numpy.array_equal(mask,inside),'Trial %i (evenodd=%s): masks differ' % (i,evenodd)
+
+def test_getPolygonLabels():
+    rand = random.Random(5678)
+    for i in range(0,NTRIALS/4):
+        polygons = [getRandomPolygon(rand) for j in range(0,rand.randrange(1,6))]
+        geodict = getRandomGeodict(rand)
+        x,y = getNodes(geodict)
+        for evenodd in [False,True]:
+            labels = getPolygonLabels(polygons,geodict,evenodd=evenodd)
+            assert labels.shape == (geodict['nrows'],geodict['ncols'])
+            reference = -numpy.ones(labels.shape,dtype=numpy.intp)
+            for j in range(len(polygons)-1,-1,-1):
+                reference[polygons[j].containsPoints(x,y,evenodd=evenodd)] = j
+            assert numpy.array_equal(labels,reference),'Trial %i (evenodd=%s): labels differ' % (i,evenodd)
+    #no polygons
+    geodict = getRandomGeodict(rand)
+    assert (getPolygonLabels([],geodict) == -1).all()
+
+if __name__ == '__main__':
+    test_getPolygonMask()
+    test_getPolygonLabels()
+    print 'All tests passed.'